@@ -23,3 +23,9 @@ class ShippingType(str, Enum):
     container = "container"
     pickup = "pickup"
     urgent = "urgent"
+
+
+class WebhookEvent(str, Enum):
+    messages = "messages"
+    statuses = "statuses"
+    unknown = "unknown"
@@ -1,20 +1,21 @@
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
-
 from bot.utils.io import make_request
 
+BASE_URL = "https://www.fordpartsgiant.com"
+
 
 def get_product_page(part_number: str) -> str:
     """Get the link to the Ford part."""
-    base_url = "https://www.fordpartsgiant.com"
-    path = f"{base_url}/parts/{part_number}.html"
-    content = make_request(urljoin(base_url, path), None, json=False)
+    path = f"{BASE_URL}/parts/{part_number}.html"
+    content = make_request(urljoin(BASE_URL, path), None, json=False)
     return content
 
 
 def _extract_weight(page: str) -> float:
     """Get the weight of the Ford part."""
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(page, "html.parser")
     row = soup.find("td", string="Item Weight")
     if row is None:
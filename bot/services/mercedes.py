@@ -1,13 +1,13 @@
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
-
 from bot.utils.io import make_request
 
+BASE_URL = "https://www.fixparts-online.com"
+
 
 def _get_mercedes_entries(part_number: str) -> list[dict]:
     """Get the entries from the API."""
-    base_url = "https://www.fixparts-online.com/en/Catalogs/"
+    base_url = urljoin(BASE_URL, "/en/Catalogs/")
     # send form data
     params = {"s": part_number}
     headers = {
@@ -20,6 +20,8 @@ def _get_mercedes_entries(part_number: str) -> list[dict]:
 
 def _extract_mercedes_linkpath(html: str, part_number: str) -> str:
     """Extract the links from the HTML."""
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, "html.parser")
     cards = soup.find_all("div", class_="mobile__table")
     for one in cards:
@@ -31,8 +33,7 @@ def _extract_mercedes_linkpath(html: str, part_number: str) -> str:
 
 def _get_mercedes_product_page(linkpath: str) -> str:
     """Get the product from the API."""
-    base_url = "https://www.fixparts-online.com"
-    url = urljoin(base_url, linkpath)
+    url = urljoin(BASE_URL, linkpath)
     headers = {
         "referral": "https://www.fixparts-online.com/en/Catalogs/",
     }
@@ -42,6 +43,8 @@ def _get_mercedes_product_page(linkpath: str) -> str:
 
 def _extract_mercedes_product_weight(html: str) -> float:
     """Extract the weight from the HTML."""
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, "html.parser")
     weight_row = soup.find("div", class_="name", string="Weight")
     if weight_row is None:
@@ -1,15 +1,43 @@
+import argparse
+import itertools
 import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime as dt
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
 
-from moysklad import MoySklad
-from moysklad.http import MoySkladHttpClient
-from moysklad.http.utils import ApiResponse
-from moysklad.queries import Query, Search
-from moysklad.urls import ApiUrlRegistry
+import requests
 from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
 
+from bot.log import setup_logger
 from bot.scheme.parts import PartOrder
+from bot.services.moy_sklad_cache import MetaCache, ProductMirror
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from bot.workers.pdf import PdfOrderProcessor
+
+logger = setup_logger(__name__)
+
+API_URL = "https://api.moysklad.ru/api/remap/1.2"
+# Максимальное число объектов в одном массовом запросе
+MAX_BATCH_SIZE = 1000
+# Артикулов в одном фильтре, чтобы не превысить длину url
+ARTICLES_PER_FILTER = 100
+# Максимальный размер страницы списка, с expand он меньше
+MAX_PAGE_SIZE = 1000
+MAX_EXPAND_PAGE_SIZE = 100
+# Страниц, загружаемых параллельно при синхронизации каталога
+SYNC_PREFETCH = 2
+# Ограничения API: 45 запросов за 3 секунды и 5 параллельных запросов
+RATE_LIMIT = 45
+RATE_PERIOD = 3.0
+MAX_CONCURRENT_REQUESTS = 5
+MAX_RETRIES = 5
 
 
 class SupplyPosition(BaseModel):
@@ -20,6 +48,147 @@ class SupplyPosition(BaseModel):
     assortment: dict = Field(..., description="Метаданные товара")
 
 
+class RateLimiter:
+    """Корзина токенов с ограничением числа одновременных запросов
+
+    Один экземпляр разделяется всеми клиентами одной учетной записи.
+    """
+
+    def __init__(
+        self,
+        rate: int = RATE_LIMIT,
+        period: float = RATE_PERIOD,
+        max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+    ):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def _wait_time(self) -> float:
+        """Забрать токен или вернуть время ожидания следующего"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(
+            self.rate, self._tokens + (now - self._updated) * self.rate / self.period
+        )
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * self.period / self.rate
+
+    def acquire(self) -> None:
+        self._slots.acquire()
+        while True:
+            with self._lock:
+                delay = self._wait_time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def release(self) -> None:
+        self._slots.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def pause(self, seconds: float) -> None:
+        """Приостановить все запросы, например после ответа 429
+
+        За время паузы корзина наполняется, как и лимит на стороне API.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Ограничения действуют на учетную запись, поэтому корзина общая
+RATE_LIMITER = RateLimiter()
+PRODUCTS_LOCK = threading.Lock()
+
+
+def _retry_after(resp: requests.Response, attempt: int) -> float:
+    """Секунды до повтора запроса по заголовкам ответа 429"""
+    for header, scale in [
+        ("X-Lognex-Retry-After", 1e-3),
+        ("X-Lognex-Reset", 1e-3),
+        ("Retry-After", 1),
+    ]:
+        try:
+            return float(resp.headers[header]) * scale
+        except (KeyError, ValueError):
+            continue
+    return RATE_PERIOD * 2**attempt * random.uniform(0.5, 1)
+
+
+class RequestScheduler:
+    """Параллельное выполнение независимых вызовов API
+
+    Число потоков равно числу разрешенных параллельных запросов, частоту
+    запросов ограничивает RateLimiter внутри MoySkladSDK._request.
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_REQUESTS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+
+class UpsertStats(BaseModel):
+    created: int = Field(0, description="Создано товаров")
+    updated: int = Field(0, description="Обновлено товаров")
+    unchanged: int = Field(0, description="Товаров без изменений")
+
+    def __str__(self):
+        return (
+            f"создано {self.created}, обновлено {self.updated}, "
+            f"без изменений {self.unchanged}"
+        )
+
+
+def _href(meta: Optional[dict]) -> Optional[str]:
+    """Ссылка на сущность без параметров запроса"""
+    if not meta or not meta.get("href"):
+        return None
+    return meta["href"].split("?", maxsplit=1)[0]
+
+
+def _product_fields(product: dict) -> dict:
+    """Нормализованные значения полей товара, которыми мы управляем"""
+    buy_price = product.get("buyPrice") or {}
+    return dict(
+        name=(product.get("name") or "").strip(),
+        code=(product.get("code") or "").strip(),
+        article=(product.get("article") or "").strip(),
+        buyPrice=(
+            round(float(buy_price.get("value") or 0), 2),
+            _href((buy_price.get("currency") or {}).get("meta")),
+        ),
+    )
+
+
+def product_changes(payload: dict, existing: dict) -> dict:
+    """Поля payload, значения которых отличаются от существующего товара"""
+    new = _product_fields(payload)
+    old = _product_fields(existing)
+    return {k: payload[k] for k in new if k in payload and new[k] != old[k]}
+
+
 class MoySkladSDK(BaseModel):
     login: str = Field(os.getenv("MOYSKLAD_LOGIN"), description="Логин пользователя")
     password: str = Field(
@@ -28,9 +197,29 @@ class MoySkladSDK(BaseModel):
     pos_token: str = Field(
         os.getenv("MOYSKLAD_POS_TOKEN"), description="Токен POS-приложения"
     )
-    moy_sklad: MoySklad = None
-    methods: ApiUrlRegistry = None
-    client: MoySkladHttpClient = None
+    base_url: str = Field(
+        os.getenv("MOYSKLAD_API_URL", API_URL),
+        description="Адрес JSON API, например локальной заглушки",
+    )
+    session: requests.Session = None
+    limiter: RateLimiter = Field(
+        default_factory=lambda: RATE_LIMITER,
+        description="Ограничение частоты запросов учетной записи",
+    )
+    batch_size: int = Field(
+        MAX_BATCH_SIZE,
+        ge=1,
+        le=MAX_BATCH_SIZE,
+        description="Число товаров в одном массовом запросе",
+    )
+    mirror: Optional[ProductMirror] = Field(
+        default_factory=ProductMirror.from_env,
+        description="Локальная копия каталога товаров",
+    )
+    meta_cache: Optional[MetaCache] = Field(
+        default_factory=MetaCache.from_env,
+        description="Общий кэш метаданных справочников по имени",
+    )
     meta: dict = {}
     names: dict = {}
 
@@ -38,11 +227,37 @@ class MoySkladSDK(BaseModel):
         arbitrary_types_allowed = True
 
     def init(self):
-        self.moy_sklad = MoySklad.get_instance(
-            login=self.login, password=self.password, pos_token=self.pos_token
-        )
-        self.methods = self.moy_sklad.get_methods()
-        self.client = self.moy_sklad.get_client()
+        self.session = requests.Session()
+        if self.login:
+            self.session.auth = (self.login, self.password)
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict] = None,
+        data: Optional[dict | list] = None,
+    ) -> dict | list:
+        """Выполнить запрос к JSON API и вернуть тело ответа
+
+        Запросы проходят через общий RateLimiter, после ответа 429 все запросы
+        ждут время из заголовков ответа и запрос повторяется.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            with self.limiter:
+                resp = self.session.request(
+                    method,
+                    f"{self.base_url.rstrip('/')}/{path}",
+                    params=params,
+                    json=data,
+                    timeout=60,
+                )
+            if resp.status_code != 429 or attempt == MAX_RETRIES:
+                break
+            self.limiter.pause(_retry_after(resp, attempt))
+        resp.raise_for_status()
+        return resp.json()
 
     @staticmethod
     def _find_name_key(keys: list[str]) -> str | None:
@@ -53,16 +268,24 @@ class MoySkladSDK(BaseModel):
     def _get_meta(self, entity: str, name: Optional[str] = None) -> dict:
         if entity in self.meta:
             return self.meta[entity]
+        # Перечисления приводятся к значению, например валюта
+        cache_key = str(getattr(name, "value", name)) if name else None
+        if cache_key and "/" in entity:
+            # Счета с одним названием у разных организаций различаются
+            parent = entity.split("/", maxsplit=1)[0]
+            cache_key = f"{getattr(self, parent)['href']}/{cache_key}"
+        if cache_key and self.meta_cache:
+            if cached := self.meta_cache.get(entity, cache_key):
+                self.meta[entity] = cached
+                return cached
 
-        entities = self._list_entities(entity)
+        rows = list(self.iter_entities(entity))
         names = [
-            one.get("name", one[self._find_name_key(list(one.keys()))])
-            for one in entities.rows
+            one.get("name", one[self._find_name_key(list(one.keys()))]) for one in rows
         ]
         if name:
-            org_meta = [
-                org.get("meta") for org in entities.rows if org.get("name") == name
-            ]
+            # Имя ищется так же, как показывается, у счетов это название банка
+            org_meta = [row.get("meta") for row, one in zip(rows, names) if one == name]
             if len(org_meta) != 1:
                 raise ValueError(
                     f"Найдено {len(org_meta)} сущностей {entity!r} с именем {name!r}: {org_meta}"
@@ -78,46 +301,219 @@ class MoySkladSDK(BaseModel):
                     "Выберите сущность (введите порядковый номер): "
                 )
             )
-            if selected_org < 1 or selected_org > len(entities.rows):
+            if selected_org < 1 or selected_org > len(rows):
                 raise ValueError("Неверный порядковый номер")
-            org_meta = entities.rows[selected_org - 1].get("meta")
+            org_meta = rows[selected_org - 1].get("meta")
 
         self.meta[entity] = org_meta
+        if cache_key and self.meta_cache:
+            self.meta_cache.set(entity, cache_key, org_meta)
         return org_meta
 
-    def _create_product(self, part: PartOrder) -> dict:
-        """Создать или обновить сущность товара"""
-        payload = dict(
+    def _entity_path(self, entity: str) -> str:
+        if "/" in entity:
+            parent, child = entity.split("/", maxsplit=1)
+            parent_id = getattr(self, parent)["href"].split("/")[-1]
+            return f"entity/{parent}/{parent_id}/{child}"
+        return f"entity/{entity}"
+
+    @staticmethod
+    def _filter_param(filters: str | dict) -> str:
+        """Фильтр в формате API, значения списком объединяются через ИЛИ"""
+        if isinstance(filters, str):
+            return filters
+        return ";".join(
+            f"{k}={one}"
+            for k, v in filters.items()
+            for one in (v if isinstance(v, (list, tuple, set)) else [v])
+        )
+
+    def iter_entities(
+        self,
+        entity: str,
+        search: Optional[str] = None,
+        filters: Optional[str | dict] = None,
+        expand: Optional[str | list[str]] = None,
+        limit: Optional[int] = None,
+        prefetch: int = 0,
+    ) -> Iterator[dict]:
+        """Строки списка сущностей постранично
+
+        Args:
+            entity: сущность, например product или organization/accounts
+            search: контекстный поиск
+            filters: фильтр в формате API, например "updated>=2023-05-01 00:00:00",
+                или словарь поле - значение или список значений
+            expand: связанные сущности, которые нужно раскрыть в строках
+            limit: размер страницы, по умолчанию максимальный
+            prefetch: число следующих страниц, загружаемых параллельно
+
+        Returns:
+            Генератор строк в порядке API.
+        """
+        params = {}
+        if search:
+            params["search"] = search
+        if filters:
+            params["filter"] = self._filter_param(filters)
+        if expand:
+            params["expand"] = expand if isinstance(expand, str) else ",".join(expand)
+        max_limit = MAX_EXPAND_PAGE_SIZE if expand else MAX_PAGE_SIZE
+        limit = min(limit or max_limit, max_limit)
+        path = self._entity_path(entity)
+
+        def fetch(offset: int) -> dict:
+            return self._request(
+                "GET", path, params=dict(params, limit=limit, offset=offset)
+            )
+
+        page = fetch(0)
+        yield from page["rows"]
+        size = page.get("meta", {}).get("size")
+        if size is None:
+            # Без общего числа строк страницы читаются до неполной
+            offset = 0
+            while len(page["rows"]) == limit:
+                offset += limit
+                page = fetch(offset)
+                yield from page["rows"]
+            return
+
+        offsets = iter(range(limit, size, limit))
+        if prefetch <= 0:
+            for offset in offsets:
+                yield from fetch(offset)["rows"]
+            return
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque(
+                executor.submit(fetch, offset)
+                for offset in itertools.islice(offsets, prefetch)
+            )
+            while pending:
+                rows = pending.popleft().result()["rows"]
+                if (offset := next(offsets, None)) is not None:
+                    pending.append(executor.submit(fetch, offset))
+                yield from rows
+
+    def sync_products(self, full: bool = False) -> int:
+        """Обновить локальную копию каталога товаров
+
+        Загружаются товары, измененные после предыдущей синхронизации. Удаленные
+        в МойСклад товары пропадают из копии только при полной синхронизации.
+
+        Args:
+            full: загрузить каталог заново
+
+        Returns:
+            Число загруженных товаров.
+        """
+        since = None if full else self.mirror.last_updated
+        last_updated, seen, batch = since, set(), []
+        for row in self.iter_entities(
+            "product",
+            filters=f"updated>={since}" if since else None,
+            prefetch=SYNC_PREFETCH,
+        ):
+            batch.append(row)
+            seen.add(row["id"])
+            last_updated = max(last_updated or "", row.get("updated") or "")
+            if len(batch) == MAX_BATCH_SIZE:
+                self.mirror.upsert(batch)
+                batch = []
+        self.mirror.upsert(batch)
+        if full:
+            self.mirror.prune(seen)
+        if last_updated:
+            self.mirror.last_updated = last_updated
+        print(f"Синхронизировано товаров: {len(seen)}")
+        return len(seen)
+
+    def _product_payload(self, part: PartOrder) -> dict:
+        return dict(
             name=part.part_name,
             code=part.part_number,
             article=part.part_number,
             supplier=dict(meta=self.counterparty),
             buyPrice=dict(value=part.price * 100, currency=dict(meta=self.currency)),
         )
-        existing = self._list_entities("product", search=part.part_number)
-
-        if len(existing.rows) == 0:
-            resp = self._create_entity("product", data=payload)
-            print(f"Создана сущность {part.part_number!r}")
-            meta = resp.meta
-        elif len(existing.rows) == 1:
-            meta = existing.rows[0]["meta"]
-            # Обновить существующую сущность
-            product_id = existing.rows[0].get("id")
-            for k, v in payload.items():
-                if v != existing.rows[0].get(k):
-                    resp = self._update_entity(
-                        "product", entity_id=product_id, data=payload
-                    )
-                    print(f"Обновлен товар {part.part_number!r}")
-                    meta = resp.meta
-                    break
+
+    def _find_products(self, articles: list[str]) -> dict[str, list[dict]]:
+        """Найти товары по артикулам одним запросом с фильтром на каждые
+        ARTICLES_PER_FILTER артикулов"""
+        found = defaultdict(list)
+        for i in range(0, len(articles), ARTICLES_PER_FILTER):
+            chunk = articles[i : i + ARTICLES_PER_FILTER]
+            for row in self.iter_entities("product", filters=dict(article=chunk)):
+                found[row.get("article")].append(row)
+        return found
+
+    def _upsert_products(
+        self, parts: list[PartOrder], use_mirror: bool = True
+    ) -> tuple[list[dict], UpsertStats]:
+        """Создать или обновить товары массовыми запросами
+
+        Отправляются только новые товары и изменившиеся поля существующих.
+
+        Args:
+            parts: список товаров, артикулы могут повторяться
+            use_mirror: искать товары в локальной копии, если она
+                синхронизирована, иначе через API
+
+        Returns:
+            Метаданные товаров в порядке списка и число созданных, обновленных
+            и неизмененных товаров.
+        """
+        payloads = {p.part_number: self._product_payload(p) for p in parts}
+        use_mirror = bool(
+            use_mirror and self.mirror is not None and self.mirror.last_updated
+        )
+        if use_mirror:
+            existing = self.mirror.find(list(payloads))
         else:
-            raise ValueError(
-                f"Найдено {len(existing.rows)} сущностей с артикулом {part.part_number!r}:\n{existing.rows}"
+            existing = self._find_products(list(payloads))
+            if self.mirror is not None:
+                self.mirror.upsert(row for rows in existing.values() for row in rows)
+
+        metas = {}
+        changes = []  # пары (артикул, тело запроса)
+        stats = UpsertStats()
+        for article, payload in payloads.items():
+            rows = existing.get(article, [])
+            if len(rows) > 1:
+                raise ValueError(
+                    f"Найдено {len(rows)} сущностей с артикулом {article!r}:\n{rows}"
+                )
+            elif not rows:
+                changes.append((article, payload))
+                stats.created += 1
+            elif changed := product_changes(payload, rows[0]):
+                # Массовый запрос обновляет сущности с переданными метаданными
+                changes.append((article, dict(meta=rows[0]["meta"], **changed)))
+                stats.updated += 1
+            else:
+                metas[article] = rows[0]["meta"]
+                stats.unchanged += 1
+
+        for i in range(0, len(changes), self.batch_size):
+            batch = changes[i : i + self.batch_size]
+            resp = self._request(
+                "POST", "entity/product", data=[payload for _, payload in batch]
             )
+            for (article, _), row in zip(batch, resp):
+                if "errors" in row and use_mirror:
+                    # Товар мог быть удален после синхронизации копии
+                    self.mirror.invalidate(list(payloads))
+                    return self._upsert_products(parts, use_mirror=False)
+                if "errors" in row:
+                    raise ValueError(
+                        f"Ошибка сохранения товара {article!r}: {row['errors']}"
+                    )
+                metas[article] = row["meta"]
+            if self.mirror is not None:
+                self.mirror.upsert(resp)
+        print(f"Товары: {stats}")
 
-        return meta
+        return [metas[p.part_number] for p in parts], stats
 
     def __getattr__(self, item):
         """Получить метаданные сущности"""
@@ -133,22 +529,6 @@ class MoySkladSDK(BaseModel):
         else:
             return getattr(self, item)
 
-    def _list_entities(
-        self, entity: str, search: Optional[str] = None
-    ) -> list[ApiResponse]:
-        if "/" in entity:
-            parent, child = entity.split("/", maxsplit=1)
-            parent_id = getattr(self, parent)["href"].split("/")[-1]
-            endpoint_url = self.methods.get_relation_list_url(
-                entity_name=parent, entity_id=parent_id, relation_entity_name=child
-            )
-        else:
-            endpoint_url = self.methods.get_list_url(entity)
-        return self.client.get(
-            endpoint_url,
-            query=Query(Search(search)) if search else None,
-        )
-
     def create_supply(
         self,
         products: list[PartOrder],
@@ -156,7 +536,7 @@ class MoySkladSDK(BaseModel):
         vat_enabled: bool = False,
         vat_included: bool = False,
         vat_rate: float = 0.0,
-    ) -> ApiResponse:
+    ) -> dict:
         """Создать приемку из списка товаров
 
         Args:
@@ -169,7 +549,10 @@ class MoySkladSDK(BaseModel):
         Returns:
             Ответ сервера.
         """
-        items_meta = [self._create_product(p) for p in products]
+        # Одинаковые новые артикулы параллельных приемок не должны
+        # создать дубликаты товаров
+        with PRODUCTS_LOCK:
+            items_meta, _ = self._upsert_products(products)
         payload = dict(
             vatEnabled=vat_enabled,
             vatIncluded=vat_included,
@@ -183,15 +566,32 @@ class MoySkladSDK(BaseModel):
                 for p, m in zip(products, items_meta)
             ],
         )
-        resp = self._create_entity("supply", data=payload)
-        print(f"Создана приемка {resp.data['name']} от {resp.data['moment']}")
+        try:
+            resp = self._create_entity("supply", data=payload)
+        except requests.HTTPError as e:
+            mirrored = self.mirror is not None and self.mirror.last_updated
+            if not mirrored or e.response.status_code >= 500:
+                raise
+            # Товар из копии мог быть удален после синхронизации,
+            # товары приемки ищутся заново через API
+            self.mirror.invalidate([p.part_number for p in products])
+            with PRODUCTS_LOCK:
+                items_meta, _ = self._upsert_products(products, use_mirror=False)
+            payload["positions"] = [
+                self._create_supply_position(p, m, vat_rate).dict()
+                for p, m in zip(products, items_meta)
+            ]
+            resp = self._create_entity("supply", data=payload)
+        print(f"Создана приемка {resp['name']} от {resp['moment']}")
         return resp
 
-    def _create_entity(self, entity: str, data: dict):
-        return self.client.post(self.methods.get_list_url(entity), data=data)
+    def _create_entity(self, entity: str, data: dict) -> dict:
+        return self._request("POST", self._entity_path(entity), data=data)
 
-    def _update_entity(self, entity: str, entity_id: str, data: dict):
-        return self.client.put(self.methods.get_by_id_url(entity, entity_id), data=data)
+    def _update_entity(self, entity: str, entity_id: str, data: dict) -> dict:
+        return self._request(
+            "PUT", f"{self._entity_path(entity)}/{entity_id}", data=data
+        )
 
     def _create_supply_position(
         self, part: PartOrder, meta: dict, vat: float = 0.0
@@ -209,7 +609,7 @@ class MoySkladSDK(BaseModel):
         else:
             return dt.strftime(dt.now(), "%Y-%m-%d %H:%M:%S")
 
-    def create_paymentout(self, total: float, vat_rate: float = 0.0) -> ApiResponse:
+    def create_paymentout(self, total: float, vat_rate: float = 0.0) -> dict:
         payload = dict(
             organization=dict(meta=self.organization),
             organizationAccount=dict(meta=getattr(self, "organization/accounts")),
@@ -220,36 +620,139 @@ class MoySkladSDK(BaseModel):
             sum=int(total * 100),
             vatSum=int(total * vat_rate * 100),
         )
-        self._create_entity("paymentout", data=payload)
+        resp = self._create_entity("paymentout", data=payload)
+        currency, counterparty = (
+            getattr(self.names[k], "value", self.names[k])
+            for k in ["currency", "counterparty"]
+        )
         print(
-            f"Создан исходящий платеж {payload['sum'] / 100} {self.names['currency'].value}"
-            f" в пользу {self.names['counterparty'].value}"
+            f"Создан исходящий платеж {payload['sum'] / 100} {currency}"
+            f" в пользу {counterparty}"
         )
+        return resp
 
 
-if __name__ == "__main__":
+# Справочники, общие для заказов всех поставщиков
+SHARED_ENTITIES = ["organization", "organization/accounts", "store", "expenseitem"]
+
+
+def read_orders(
+    files: list[str], checksums: Optional[list[float]] = None
+) -> list[tuple["PdfOrderProcessor", "pd.DataFrame"]]:
+    """Разобрать pdf заказы поставщиков
+
+    Returns:
+        Обработчик заказа и строки заказа для каждого разобранного файла,
+        файлы с ошибками пропускаются.
+    """
     from bot.workers import pdf
 
-    order = pdf.PdfOrderEuropeanAutospares(
-        "/Users/rustem.galiullin/Downloads/SOW.12436.pdf", checksum=1698.9
-    )
-    order_items = order.run()
+    orders = []
+    for file, checksum in zip(files, checksums or [None] * len(files)):
+        try:
+            match, order_items = pdf.process_order(file, checksum=checksum)
+        except Exception as e:
+            logger.error(f"failed to read order {file}", exc_info=e)
+            continue
+        orders.append((match.processor(file=file), order_items))
+    return orders
 
-    sklad = MoySkladSDK(
-        names=dict(
-            organization=None,
-            counterparty=order.supplier_name,
-            currency=order.currency,
-            store="Al Fada Dubai",
-        )
-    )
-    sklad.init()
-    parts = [PartOrder(**item) for item in order_items.to_dict(orient="records")]
-    sklad.create_supply(
-        parts,
+
+def _import_order(
+    client: MoySkladSDK, order: "PdfOrderProcessor", order_items: "pd.DataFrame"
+) -> tuple[dict, dict]:
+    supply = client.create_supply(
+        order.to_parts(order_items),
         vat_rate=order.vat,
         invoice_date=order_items["invoice_date"].iloc[0],
         vat_included=False,
         vat_enabled=True,
     )
-    sklad.create_paymentout(total=order_items["amount"].sum(), vat_rate=order.vat)
+    paymentout = client.create_paymentout(
+        total=order_items["amount"].sum(), vat_rate=order.vat
+    )
+    return supply, paymentout
+
+
+def import_orders(
+    sklad: MoySkladSDK,
+    orders: list[tuple["PdfOrderProcessor", "pd.DataFrame"]],
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+) -> list[Future]:
+    """Создать приемки и исходящие платежи по заказам параллельно
+
+    Заказы загружаются одновременно в пределах ограничений API.
+
+    Args:
+        sklad: клиент с названиями общих справочников в names
+        orders: результат read_orders
+        max_workers: число заказов, загружаемых параллельно
+
+    Returns:
+        Завершенные задачи заказов с ответами на создание приемки и платежа.
+    """
+    # Общие справочники выбираются один раз до запуска потоков
+    shared = {entity: getattr(sklad, entity) for entity in SHARED_ENTITIES}
+
+    futures = []
+    with RequestScheduler(max_workers=max_workers) as scheduler:
+        for order, order_items in orders:
+            client = sklad.copy(
+                update=dict(
+                    names=dict(
+                        sklad.names,
+                        counterparty=order.supplier_name,
+                        currency=order.currency,
+                    ),
+                    meta=dict(shared),
+                )
+            )
+            futures.append(scheduler.submit(_import_order, client, order, order_items))
+    wait(futures)
+    return futures
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description="Загрузка заказов в МойСклад")
+    commands = parser.add_subparsers(dest="command", required=True)
+    supply = commands.add_parser("supply", help="Создать приемки и платежи по заказам")
+    supply.add_argument("files", nargs="+", help="pdf заказов поставщиков")
+    supply.add_argument(
+        "--checksums", type=float, nargs="+", help="Суммы заказов для проверки"
+    )
+    supply.add_argument("--store", default="Al Fada Dubai", help="Склад")
+    sync = commands.add_parser("sync", help="Обновить локальную копию каталога")
+    sync.add_argument("--full", action="store_true", help="Загрузить каталог заново")
+    invalidate = commands.add_parser("invalidate", help="Очистить кэш справочников")
+    invalidate.add_argument("--entity", help="Сущность, по умолчанию все")
+    opts = parser.parse_args(args)
+
+    if opts.command == "invalidate":
+        if meta_cache := MetaCache.from_env():
+            deleted = meta_cache.invalidate(opts.entity)
+            print(f"Удалено из кэша справочников: {deleted}")
+        return
+
+    sklad = MoySkladSDK(
+        names=dict(organization=None, store=getattr(opts, "store", None))
+    )
+    sklad.init()
+    if opts.command == "supply":
+        if opts.checksums and len(opts.checksums) != len(opts.files):
+            parser.error("Число сумм должно совпадать с числом заказов")
+        if sklad.mirror is not None and sklad.mirror.last_updated:
+            # Загружаются только товары, измененные после прошлой синхронизации
+            sklad.sync_products()
+        orders = read_orders(opts.files, opts.checksums)
+        futures = import_orders(sklad, orders)
+        for (order, _), future in zip(orders, futures):
+            if future.exception():
+                print(f"Ошибка загрузки {order.file}: {future.exception()!r}")
+    elif opts.command == "sync":
+        if sklad.mirror is None:
+            parser.error("Локальная копия отключена, задайте MOYSKLAD_CACHE_PATH")
+        sklad.sync_products(full=opts.full)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Local SQLite copies of MoySklad data shared between processes.
+
+The product mirror answers article lookups without API calls and is kept
+fresh by incremental syncs on the ``updated`` timestamp of products. The meta
+cache remembers reference entities such as the organization or the store by
+name for a limited time. Both are kept in the file at ``MOYSKLAD_CACHE_PATH``
+and are disabled unless it is set.
+
+Incremental syncs do not see products deleted in MoySklad, a full sync
+prunes them and products the API rejects are dropped from the mirror.
+"""
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+from bot.utils.store import SqliteStore
+
+DEFAULT_META_TTL = 24 * 60 * 60
+
+_PRODUCTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    article TEXT,
+    code TEXT,
+    name TEXT,
+    buy_price REAL,
+    currency_href TEXT,
+    meta_href TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS products_article ON products (article);
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+_METAS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metas (
+    entity TEXT NOT NULL,
+    name TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    cached_at REAL NOT NULL,
+    PRIMARY KEY (entity, name)
+);
+"""
+
+
+def _env_path() -> Optional[Path]:
+    """Database in MOYSKLAD_CACHE_PATH, None unless the variable is set."""
+    path = os.getenv("MOYSKLAD_CACHE_PATH")
+    return Path(path) if path else None
+
+
+class ProductMirror(SqliteStore):
+    """Products of the MoySklad catalog indexed by article."""
+
+    schema = _PRODUCTS_SCHEMA
+
+    @classmethod
+    def from_env(cls) -> Optional["ProductMirror"]:
+        """Mirror in MOYSKLAD_CACHE_PATH, disabled unless the variable is set."""
+        path = _env_path()
+        return cls(path) if path else None
+
+    def upsert(self, rows: Iterable[dict]) -> int:
+        """Save products as returned by the API, returns the number of rows."""
+        records = []
+        for row in rows:
+            buy_price = row.get("buyPrice") or {}
+            currency = (buy_price.get("currency") or {}).get("meta") or {}
+            records.append(
+                (
+                    row["id"],
+                    row.get("article"),
+                    row.get("code"),
+                    row.get("name"),
+                    buy_price.get("value"),
+                    currency.get("href"),
+                    row["meta"]["href"],
+                    json.dumps(row["meta"]),
+                    row.get("updated"),
+                )
+            )
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+        return len(records)
+
+    def find(self, articles: list[str]) -> dict[str, list[dict]]:
+        """Products by article in the shape of API rows."""
+        found = {}
+        # sqlite limits the number of query parameters
+        for i in range(0, len(articles), 500):
+            chunk = articles[i : i + 500]
+            cursor = self.conn.execute(
+                "SELECT * FROM products WHERE article IN "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for one in cursor:
+                row = dict(
+                    id=one["id"],
+                    article=one["article"],
+                    code=one["code"],
+                    name=one["name"],
+                    meta=json.loads(one["meta"]),
+                    updated=one["updated"],
+                )
+                if one["buy_price"] is not None:
+                    row["buyPrice"] = dict(value=one["buy_price"])
+                    if one["currency_href"]:
+                        row["buyPrice"]["currency"] = dict(
+                            meta=dict(href=one["currency_href"])
+                        )
+                found.setdefault(one["article"], []).append(row)
+        return found
+
+    def invalidate(self, articles: list[str]) -> int:
+        """Delete products by article, returns the number deleted."""
+        deleted = 0
+        with self._lock, self.conn:
+            for i in range(0, len(articles), 500):
+                chunk = articles[i : i + 500]
+                cursor = self.conn.execute(
+                    "DELETE FROM products WHERE article IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+                deleted += cursor.rowcount
+        return deleted
+
+    def prune(self, keep: set[str]) -> int:
+        """Delete products with ids not in keep, returns the number deleted."""
+        with self._lock, self.conn:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep (id TEXT)")
+            self.conn.execute("DELETE FROM keep")
+            self.conn.executemany("INSERT INTO keep VALUES (?)", [(i,) for i in keep])
+            cursor = self.conn.execute(
+                "DELETE FROM products WHERE id NOT IN (SELECT id FROM keep)"
+            )
+            return cursor.rowcount
+
+    @property
+    def last_updated(self) -> Optional[str]:
+        """The latest ``updated`` timestamp seen by a sync."""
+        one = self.conn.execute(
+            "SELECT value FROM sync_state WHERE name = 'products'"
+        ).fetchone()
+        return one["value"] if one else None
+
+    @last_updated.setter
+    def last_updated(self, value: str) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES ('products', ?)", (value,)
+            )
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+
+class MetaCache(SqliteStore):
+    """Metas of reference entities by entity and name with a time to live."""
+
+    schema = _METAS_SCHEMA
+    repr_fields = ("path", "ttl")
+
+    def __init__(self, path: str | Path, ttl: float = DEFAULT_META_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls) -> Optional["MetaCache"]:
+        """Cache in MOYSKLAD_CACHE_PATH expiring after MOYSKLAD_META_TTL seconds,
+        disabled unless the path is set or if the ttl is zero."""
+        path = _env_path()
+        ttl = float(os.getenv("MOYSKLAD_META_TTL", DEFAULT_META_TTL) or 0)
+        return cls(path, ttl=ttl) if path and ttl > 0 else None
+
+    def get(self, entity: str, name: str) -> Optional[dict]:
+        one = self.conn.execute(
+            "SELECT meta FROM metas WHERE entity = ? AND name = ? AND cached_at > ?",
+            (entity, name, time.time() - self.ttl),
+        ).fetchone()
+        return json.loads(one["meta"]) if one else None
+
+    def set(self, entity: str, name: str, meta: dict) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metas VALUES (?, ?, ?, ?)",
+                (entity, name, json.dumps(meta), time.time()),
+            )
+
+    def invalidate(self, entity: Optional[str] = None) -> int:
+        """Forget metas of an entity or all of them, returns the number deleted."""
+        with self._lock, self.conn:
+            if entity:
+                cursor = self.conn.execute(
+                    "DELETE FROM metas WHERE entity = ?", (entity,)
+                )
+            else:
+                cursor = self.conn.execute("DELETE FROM metas")
+            return cursor.rowcount
@@ -1,9 +1,17 @@
+import functools
 from datetime import datetime as dt
-from typing import Optional
+from typing import Callable, Optional
 
-from bot.services import ford, mercedes
+from bot.log import setup_logger
+from bot.services import ford, mercedes, weight_cache
 from bot.utils.io import make_request
 
+logger = setup_logger("services")
+
+EXCHANGE_RATE_URL = "https://api.exchangerate.host"
+# hosts every quote talks to, connections are opened ahead by a warm-up
+SCRAPER_HOSTS = [EXCHANGE_RATE_URL, ford.BASE_URL, mercedes.BASE_URL]
+
 
 def get_exchange_rate(
     from_currency: str, to_currency: str, date_str: Optional[str] = None
@@ -11,7 +19,13 @@ def get_exchange_rate(
     """Get the exchange rate from the API."""
     if not date_str:
         date_str = get_today()
-    base_url = "https://api.exchangerate.host/timeseries"
+    return _get_exchange_rate(from_currency, to_currency, date_str)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_exchange_rate(from_currency: str, to_currency: str, date_str: str) -> float:
+    """Rates of a day are fetched once per process."""
+    base_url = f"{EXCHANGE_RATE_URL}/timeseries"
     params = {
         "base": from_currency,
         "symbols": to_currency,
@@ -22,16 +36,48 @@ def get_exchange_rate(
     return resp["rates"][date_str][to_currency]
 
 
-def get_part_weight(part_number: str) -> float:
+def _weight_scraper(part_number: str) -> Callable[[str], float]:
     if part_number.startswith("A"):
-        weight = mercedes.get_mercedes_weight(part_number)
+        return mercedes.get_mercedes_weight
     elif part_number.startswith(("FR", "GR")):
-        weight = ford.get_weight(part_number)
+        return ford.get_weight
     else:
         raise NotImplementedError(f"Unknown part number: {part_number}")
+
+
+def get_part_weight(part_number: str) -> float:
+    """Weight of the part from the cache or scraped from its catalog."""
+    scrape = _weight_scraper(part_number)
+    cache = weight_cache.from_env()
+    if cache is None:
+        return scrape(part_number)
+    cache.quoted(part_number)
+    if (weight := cache.get(part_number)) is not None:
+        return weight
+    weight = scrape(part_number)
+    cache.set(part_number, weight)
     return weight
 
 
+def prime_weights(limit: int = 20) -> int:
+    """Scrape weights of recently quoted parts missing in the cache.
+
+    Returns:
+        The number of weights scraped.
+    """
+    cache = weight_cache.from_env()
+    if cache is None:
+        return 0
+    scraped = 0
+    for part_number in cache.stale(limit=limit):
+        try:
+            cache.set(part_number, _weight_scraper(part_number)(part_number))
+            scraped += 1
+        except Exception as e:
+            logger.warning(f"Unable to scrape weight of {part_number}", exc_info=e)
+    return scraped
+
+
 def get_today() -> str:
     return dt.today().strftime("%Y-%m-%d")
 
@@ -0,0 +1,89 @@
+"""Local SQLite cache of part weights scraped from the catalogs.
+
+Weights are looked up for every quoted part, each scrape takes one or two
+page loads. The cache also remembers when a part was last quoted, so a
+warm-up can refresh the weights of parts customers ask about. It is kept in
+the file at ``WEIGHT_CACHE_PATH`` and is disabled unless it is set.
+"""
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from bot.utils.store import SqliteStore, open_once
+
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+
+class WeightCache(SqliteStore):
+    """Part weights in a SQLite file with a time to live.
+
+    Args:
+        path: database file, shared by processes on the same host
+        ttl: seconds a scraped weight is used
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS weights (
+        part_number TEXT PRIMARY KEY,
+        weight REAL,
+        fetched_at REAL,
+        quoted_at REAL
+    );
+    """
+    repr_fields = ("path", "ttl")
+
+    def __init__(self, path: str | Path, ttl: float = DEFAULT_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls) -> Optional["WeightCache"]:
+        """Cache in WEIGHT_CACHE_PATH, disabled unless the variable is set."""
+        path = os.getenv("WEIGHT_CACHE_PATH")
+        ttl = float(os.getenv("WEIGHT_CACHE_TTL", DEFAULT_TTL))
+        return cls(path, ttl=ttl) if path else None
+
+    def get(self, part_number: str) -> Optional[float]:
+        """Weight scraped within the ttl, None if there is none."""
+        one = self.conn.execute(
+            "SELECT weight FROM weights WHERE part_number = ? AND fetched_at > ?",
+            (part_number, time.time() - self.ttl),
+        ).fetchone()
+        return one[0] if one else None
+
+    def set(self, part_number: str, weight: float) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO weights (part_number, weight, fetched_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (part_number) DO UPDATE
+                SET weight = excluded.weight, fetched_at = excluded.fetched_at""",
+                (part_number, weight, time.time()),
+            )
+
+    def quoted(self, part_number: str) -> None:
+        """Remember that the part was quoted now."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO weights (part_number, quoted_at) VALUES (?, ?)
+                ON CONFLICT (part_number) DO UPDATE SET quoted_at = excluded.quoted_at""",
+                (part_number, time.time()),
+            )
+
+    def stale(self, limit: int = 20, days: float = 7) -> list[str]:
+        """Parts quoted in the last days without a weight within the ttl,
+        the most recently quoted first."""
+        now = time.time()
+        cursor = self.conn.execute(
+            """SELECT part_number FROM weights
+            WHERE quoted_at > ? AND (fetched_at IS NULL OR fetched_at <= ?)
+            ORDER BY quoted_at DESC LIMIT ?""",
+            (now - days * 24 * 60 * 60, now - self.ttl, limit),
+        )
+        return [one[0] for one in cursor]
+
+
+def from_env() -> Optional[WeightCache]:
+    """Cache configured by the environment, opened once per process."""
+    return open_once(WeightCache.from_env, "WEIGHT_CACHE_PATH", "WEIGHT_CACHE_TTL")
@@ -0,0 +1,115 @@
+"""Store of processed message ids to skip webhook redeliveries.
+
+WhatsApp delivers a webhook again when it does not get a response in time,
+so the same message can arrive while the first delivery is still running or
+after it has been answered. A message is claimed before any work is done,
+only the first claim succeeds until the claim is released or expires.
+
+The store is a stand-in that works for a single instance: by default the
+SQLite file is in the temporary directory, which instances of the cloud
+function do not share, so a redelivery that reaches another instance is
+processed again. ``DEDUP_PATH`` points the store at another file, such as
+one on a volume mounted by all instances, and an empty value disables it.
+"""
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from bot.utils.store import SqliteStore, open_once
+
+DEFAULT_PATH = Path(tempfile.gettempdir()) / "whatsapp-spares-dedup.sqlite"
+# meta retries deliveries for up to a week
+DEFAULT_TTL = 7 * 24 * 60 * 60
+# a claim of a crashed process expires after this many seconds
+IN_FLIGHT_TTL = 15 * 60
+
+
+class DedupStore(SqliteStore):
+    """Message ids in a SQLite file with a time to live.
+
+    Only processes that open the same file see each other's claims.
+
+    Args:
+        path: database file, shared by processes on the same host
+        ttl: seconds a processed id is remembered
+        in_flight_ttl: seconds an id being processed is claimed
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """
+    repr_fields = ("path", "ttl")
+
+    def __init__(
+        self,
+        path: str | Path,
+        ttl: float = DEFAULT_TTL,
+        in_flight_ttl: float = IN_FLIGHT_TTL,
+    ):
+        super().__init__(path)
+        self.ttl = ttl
+        self.in_flight_ttl = in_flight_ttl
+
+    @classmethod
+    def from_env(cls) -> Optional["DedupStore"]:
+        """Store in DEDUP_PATH, the temporary directory if it is not set and
+        disabled if it is empty."""
+        path = os.getenv("DEDUP_PATH", str(DEFAULT_PATH))
+        ttl = float(os.getenv("DEDUP_TTL", DEFAULT_TTL))
+        return cls(path, ttl=ttl) if path else None
+
+    def claim(self, message_id: str) -> bool:
+        """Mark the message as in flight, False if it is processed or in flight."""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM messages WHERE id = ? AND expires_at <= ?",
+                (message_id, now),
+            )
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO messages VALUES (?, 'in_flight', ?)",
+                (message_id, now + self.in_flight_ttl),
+            )
+        return cursor.rowcount == 1
+
+    def done(self, message_id: str) -> None:
+        """Remember the message as processed."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, 'done', ?)",
+                (message_id, time.time() + self.ttl),
+            )
+
+    def release(self, message_id: str) -> None:
+        """Forget a claim after a failure, so a redelivery is processed again."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM messages WHERE id = ? AND status = 'in_flight'",
+                (message_id,),
+            )
+
+    def status(self, message_id: str) -> Optional[str]:
+        one = self.conn.execute(
+            "SELECT status FROM messages WHERE id = ? AND expires_at > ?",
+            (message_id, time.time()),
+        ).fetchone()
+        return one[0] if one else None
+
+    def purge(self) -> int:
+        """Delete expired ids, returns the number deleted."""
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM messages WHERE expires_at <= ?", (time.time(),)
+            )
+        return cursor.rowcount
+
+
+def from_env() -> Optional[DedupStore]:
+    """Store configured by the environment, opened once per process."""
+    return open_once(DedupStore.from_env, "DEDUP_PATH", "DEDUP_TTL")
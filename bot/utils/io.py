@@ -1,7 +1,30 @@
-import cv2
-import numpy as np
+import struct
+from typing import TYPE_CHECKING, Optional
+
 import requests
 
+if TYPE_CHECKING:
+    import numpy as np
+
+# whatsapp accepts images up to 5 MB and documents up to 100 MB
+MAX_DOWNLOAD_BYTES = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_session: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """Session shared by scrapers to reuse connections to the same hosts."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    return _session
+
+
+def connect(url: str, timeout: float = 10) -> None:
+    """Open a pooled connection to the host of the url ahead of a request."""
+    get_session().head(url, timeout=timeout, allow_redirects=False)
+
 
 def make_request(url, params, json: bool = True, **kwargs) -> dict | str:
     """Make a request to the API."""
@@ -10,19 +33,112 @@ def make_request(url, params, json: bool = True, **kwargs) -> dict | str:
     }
     if "headers" in kwargs:
         headers.update(kwargs.pop("headers"))
-    resp = requests.get(url, params=params, headers=headers, **kwargs)
+    resp = get_session().get(url, params=params, headers=headers, **kwargs)
     resp.raise_for_status()
     return resp.json() if json else resp.content.decode()
 
 
-def download_image(url: str, **kwargs) -> np.ndarray:
+def download_bytes(
+    url: str, max_bytes: int = MAX_DOWNLOAD_BYTES, **kwargs
+) -> "np.ndarray":
+    """Stream the response body into a buffer allocated once.
+
+    The buffer has the size of the Content-Length header, it only grows if
+    the header is missing or wrong.
+
+    Raises:
+        ValueError: the body is larger than max_bytes
+    """
+    # opencv and numpy are slow to import and not needed for text quotes
+    import numpy as np
+
+    with get_session().get(url, stream=True, **kwargs) as resp:
+        resp.raise_for_status()
+        length = int(resp.headers.get("Content-Length") or 0)
+        if length > max_bytes:
+            raise ValueError(f"{url} has {length} bytes, more than {max_bytes}")
+        buffer = np.empty(length or CHUNK_SIZE, dtype=np.uint8)
+        size = 0
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            end = size + len(chunk)
+            if end > max_bytes:
+                raise ValueError(f"{url} has more than {max_bytes} bytes")
+            if end > len(buffer):
+                grown = np.empty(min(max(end, 2 * len(buffer)), max_bytes), np.uint8)
+                grown[:size] = buffer[:size]
+                buffer = grown
+            buffer[size:end] = np.frombuffer(chunk, dtype=np.uint8)
+            size = end
+    return buffer[:size]
+
+
+def image_size(data: "np.ndarray") -> Optional[tuple[int, int]]:
+    """Width and height read from a PNG or JPEG header, None for other data."""
+    if data[:8].tobytes() == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24].tobytes())
+    if data[:2].tobytes() != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        # start of frame segments, except huffman and arithmetic tables
+        if 0xC0 <= marker <= 0xCF and marker not in [0xC4, 0xC8, 0xCC]:
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9].tobytes())
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2 : i + 4].tobytes(), "big")
+    return None
+
+
+def decode_image(
+    data: "np.ndarray", max_side: Optional[int] = None, gray: bool = False
+) -> "np.ndarray":
+    """Decode an encoded image, downscaled to at most max_side pixels.
+
+    Large JPEG images are decoded at 1/2, 1/4 or 1/8 of their size right
+    away, so the full resolution image is never held in memory.
+    """
+    import cv2
+
+    # pylint: disable=no-member
+    factor = 1
+    if max_side and (size := image_size(data)):
+        # the largest reduction still leaving max_side pixels to downscale
+        while factor < 8 and max(size) / (factor * 2) >= max_side:
+            factor *= 2
+    flags = {
+        (1, False): cv2.IMREAD_COLOR,
+        (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+        (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+        (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+        (1, True): cv2.IMREAD_GRAYSCALE,
+        (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+    img = cv2.imdecode(data, flags[factor, gray])
+    if img is None:
+        raise ValueError("Unable to decode the image")
+    if max_side and (scale := max_side / max(img.shape[:2])) < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def download_image(
+    url: str,
+    max_side: Optional[int] = None,
+    gray: bool = False,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+    **kwargs,
+) -> "np.ndarray":
     """Download an image from the url."""
-    resp = requests.get(url, **kwargs)
-    resp.raise_for_status()
-    image_array = np.asarray(bytearray(resp.content), dtype="uint8")
-    return cv2.imdecode(image_array, cv2.IMREAD_COLOR)  # pylint: disable=no-member
+    return decode_image(download_bytes(url, max_bytes, **kwargs), max_side, gray)
 
 
 if __name__ == "__main__":
+    import cv2
+
     a = download_image("https://i.imgur.com/4xysyQ7.jpeg")
     cv2.imwrite("test.jpg", a)
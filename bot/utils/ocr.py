@@ -1,13 +1,25 @@
 """Utilities to extract text from images.
 """
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Callable
 
 import cv2
 import numpy as np
 import pytesseract
 
+from bot.utils import io
+
 # pylint: disable=no-member
 
+# tesseract reads text well at this size, larger photos only cost memory
+MAX_OCR_SIDE = 2400
+# memory a child process may allocate for downloading, decoding and ocr
+OCR_MEMORY_MB = int(os.getenv("OCR_MEMORY_MB", 512))
+
 
 def extract_image_text(img: np.ndarray) -> str:
     _, img_thresh = cv2.threshold(img, 180, 255, cv2.THRESH_BINARY)  # threshold image
@@ -32,6 +44,41 @@ def run_ocr(image_src: str | np.ndarray) -> str:
     return extracted
 
 
+def run_ocr_url(url: str, headers: dict) -> str:
+    """Download an image, decode it at a reduced size and run ocr on it."""
+    img = io.download_image(
+        url, max_side=MAX_OCR_SIDE, gray=True, headers=headers, timeout=60
+    )
+    return run_ocr(img)
+
+
+def _limit_memory(memory_mb: int) -> None:
+    """Let the process allocate memory_mb more than it has now."""
+    with open("/proc/self/status") as f:
+        data_kb = next(int(line.split()[1]) for line in f if line.startswith("VmData"))
+    limit = (data_kb + memory_mb * 1024) * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+
+
+def run_limited(func: Callable, *args, memory_mb: int = OCR_MEMORY_MB):
+    """Run func in a child process which gets a MemoryError above the budget.
+
+    A large photo fails on its own instead of the whole function running out
+    of memory, tesseract started by the child inherits the limit. The child is
+    spawned, forking a process whose other threads hold locks can deadlock it.
+    """
+    with ProcessPoolExecutor(
+        1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_limit_memory,
+        initargs=(memory_mb,),
+    ) as pool:
+        return pool.submit(func, *args).result()
+
+
 if __name__ == "__main__":
     path = "../../tests/data/quotes/european_quote_screenshot.jpeg"
     text = run_ocr(path)
@@ -1,7 +1,9 @@
 """Parse input messages and format them for the output.
 """
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+from typing import Iterator
 
 from bot import CONSTANTS
 from bot.log import setup_logger
@@ -139,6 +141,42 @@ def process_message(message: str) -> OutputMessage:
     return [prepare_output(msg) for msg in input_message]
 
 
+def prepare_outputs(
+    messages: list[InputMessage], batch_size: int = 5, max_workers: int = 8
+) -> Iterator[list[OutputMessage]]:
+    """Price the messages concurrently and yield them in order in batches.
+
+    A batch is yielded as soon as its messages and all before it are priced,
+    so the first lines of a long quote do not wait for the slowest ones.
+    """
+    # one exchange rate request per currency instead of a race of all lines
+    today_str = get_today()
+    for currency in {message.currency for message in messages}:
+        get_exchange_rate(currency, "RUB", today_str)
+    pool = ThreadPoolExecutor(max_workers)
+    try:
+        futures = [pool.submit(prepare_output, message) for message in messages]
+        for i in range(0, len(futures), batch_size):
+            yield [future.result() for future in futures[i : i + batch_size]]
+    finally:
+        # lines not priced yet are dropped if the caller stops early
+        pool.shutdown(cancel_futures=True)
+
+
+def format_summary(outputs: list[OutputMessage]) -> str:
+    """Closing message of a quote sent in several batches.
+
+    There is no total, quotes have unit prices without quantities.
+    """
+    lead_days = max((out.lead_days for out in outputs), default=0)
+    return "\n".join(
+        [
+            f"Итого: {len(outputs)} поз.",
+            f"Срок поставки: до {lead_days} дн.",
+        ]
+    )
+
+
 def format_date(val: str, from_format: str, to_format="%Y-%m-%d") -> str:
     """Convert str date format.
 
@@ -0,0 +1,70 @@
+"""SQLite files shared by processes on the same host.
+
+Stores keep their tables in a file opened on first use, with write-ahead
+logging so readers are not blocked by a writer in another process. Stores
+configured by environment variables are opened once per process.
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # readers in other processes are not blocked by a running write
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class SqliteStore:
+    """A table set in a SQLite database opened on first use.
+
+    Writes hold ``_lock``, the connection is shared by the threads of a
+    process. Not a dataclass on purpose, pydantic models holding it would turn
+    it into a pydantic dataclass.
+    """
+
+    schema: str = ""
+    # attributes shown by repr
+    repr_fields: tuple[str, ...] = ("path",)
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+
+    def __repr__(self):
+        fields = []
+        for name in self.repr_fields:
+            value = getattr(self, name)
+            value = str(value) if isinstance(value, Path) else value
+            fields.append(f"{name}={value!r}")
+        return f"{type(self).__name__}({', '.join(fields)})"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    conn = connect(self.path)
+                    conn.executescript(self.schema)
+                    self._conn = conn
+        return self._conn
+
+
+_opened: dict[tuple, Any] = {}
+
+
+def open_once(factory: Callable[[], T], *env_vars: str) -> T:
+    """Result of factory, called once per process for each value of env_vars."""
+    key = (factory, *(os.getenv(name) for name in env_vars))
+    if key not in _opened:
+        _opened[key] = factory()
+    return _opened[key]
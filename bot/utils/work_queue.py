@@ -0,0 +1,138 @@
+"""Work queues to process webhook events after they are acknowledged.
+
+The webhook handler puts jobs into a queue and returns right away, a worker
+takes them out and acknowledges them once they are processed. Jobs that are
+not acknowledged within the visibility timeout are handed out again, so a
+crashed worker does not lose them.
+
+Backends are chosen by the scheme of ``WORK_QUEUE_URL``, a SQLite file is
+used locally and other backends can be added with ``register_backend``.
+"""
+import json
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+from urllib.parse import ParseResult, urlparse
+
+from bot.utils.store import SqliteStore, open_once
+
+DEFAULT_URL = (
+    f"sqlite:///{Path(tempfile.gettempdir()) / 'whatsapp-spares-queue.sqlite'}"
+)
+
+
+@dataclass
+class Job:
+    id: str
+    payload: dict
+    attempts: int = 0
+
+
+class WorkQueue(ABC):
+    """A queue with at least once delivery."""
+
+    @abstractmethod
+    def put(self, payload: dict, delay: float = 0) -> str:
+        """Add a job, returns its id."""
+
+    @abstractmethod
+    def get(self, visibility_timeout: float = 60) -> Optional[Job]:
+        """Take the next available job or None if the queue is empty.
+
+        The job is hidden from other workers for visibility_timeout seconds.
+        """
+
+    @abstractmethod
+    def ack(self, job: Job) -> None:
+        """Remove a processed job."""
+
+    @abstractmethod
+    def nack(self, job: Job, delay: float = 0) -> None:
+        """Return a job to the queue to be retried after delay seconds."""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of jobs not acknowledged yet."""
+
+
+class SqliteQueue(SqliteStore, WorkQueue):
+    """Local queue in a SQLite file, shared by processes on the same host."""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_available ON jobs (available_at);
+    """
+
+    def put(self, payload: dict, delay: float = 0) -> str:
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (payload, available_at) VALUES (?, ?)",
+                (json.dumps(payload), time.time() + delay),
+            )
+        return str(cursor.lastrowid)
+
+    def get(self, visibility_timeout: float = 60) -> Optional[Job]:
+        now = time.time()
+        with self._lock, self.conn:
+            # a single statement, so concurrent workers never take the same job
+            one = self.conn.execute(
+                """UPDATE jobs SET available_at = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM jobs WHERE available_at <= ?
+                    ORDER BY available_at, id LIMIT 1
+                )
+                RETURNING id, payload, attempts""",
+                (now + visibility_timeout, now),
+            ).fetchone()
+        if one is None:
+            return None
+        return Job(id=str(one[0]), payload=json.loads(one[1]), attempts=one[2])
+
+    def ack(self, job: Job) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (int(job.id),))
+
+    def nack(self, job: Job, delay: float = 0) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET available_at = ? WHERE id = ?",
+                (time.time() + delay, int(job.id)),
+            )
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+BACKENDS: dict[str, Callable[[ParseResult], WorkQueue]] = {
+    "sqlite": lambda url: SqliteQueue(url.path),
+}
+
+
+def register_backend(scheme: str, factory: Callable[[ParseResult], WorkQueue]):
+    """Make a queue backend available for urls with the scheme."""
+    BACKENDS[scheme] = factory
+
+
+def from_url(url: str) -> WorkQueue:
+    parsed = urlparse(url)
+    if parsed.scheme not in BACKENDS:
+        raise ValueError(f"Unknown work queue backend {parsed.scheme!r} in {url!r}")
+    return BACKENDS[parsed.scheme](parsed)
+
+
+def _queue_from_env() -> WorkQueue:
+    return from_url(os.getenv("WORK_QUEUE_URL") or DEFAULT_URL)
+
+
+def from_env() -> WorkQueue:
+    """Queue at WORK_QUEUE_URL, opened once per process."""
+    return open_once(_queue_from_env, "WORK_QUEUE_URL")
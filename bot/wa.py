@@ -1,21 +1,38 @@
+import json
 import os
+import random
+import re
 import time
-from typing import Optional
+from typing import Iterator, Optional
 
 import requests
 from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from requests.adapters import HTTPAdapter
 
 from bot.log import setup_logger
+from bot.scheme.enums import WebhookEvent
 
 logger = setup_logger("whatsapp")
 
 PHONE_ID = os.getenv("WHATSAPP_PHONE_ID")
-URL = f"https://graph.facebook.com/v16.0/{PHONE_ID}/messages"
+GRAPH_URL = "https://graph.facebook.com/v16.0"
+URL = f"{GRAPH_URL}/{PHONE_ID}/messages"
+# whatsapp rejects longer text messages
+MAX_TEXT_LENGTH = 4096
+# seconds to send a reply including all retries
+SEND_DEADLINE = 120
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+POOL_SIZE = 10
+
+_session: Optional[requests.Session] = None
 
 
 class TextMessage(BaseModel):
     from_phone: str
     text: str
+    # whatsapp message id, the same for redeliveries of a webhook
+    id: Optional[str] = None
 
 
 class MediaMessage(TextMessage):
@@ -40,61 +57,117 @@ def verify_whatsapp_webhook(event: dict) -> Optional[str]:
     return None
 
 
-def _get_last_change(event_body: dict) -> dict:
-    return event_body["entry"][0]["changes"][0]["value"]
+# keys of the json body, quotes in texts of customers are escaped
+_MESSAGES_KEY = re.compile(r'(?<!\\)"messages"\s*:\s*\[')
+_STATUSES_KEY = re.compile(r'(?<!\\)"statuses"\s*:\s*\[')
+_STATUS_VALUE = re.compile(r'"status"\s*:\s*"(\w+)"')
+
+
+def classify_event(raw_body: str) -> WebhookEvent:
+    """Kind of a webhook delivery found without parsing the body.
+
+    Deliveries with a messages array are classified as messages even if they
+    have statuses too, so only pure status updates take a shortcut.
+    """
+    if _MESSAGES_KEY.search(raw_body):
+        return WebhookEvent.messages
+    if _STATUSES_KEY.search(raw_body):
+        return WebhookEvent.statuses
+    return WebhookEvent.unknown
+
+
+def read_status_names(raw_body: str) -> list[str]:
+    """Statuses (sent, delivered, read) of a status delivery without parsing it."""
+    return _STATUS_VALUE.findall(raw_body)
 
 
-def _get_phone_number(changes: list) -> str:
-    from_phone = changes["messages"][0]["from"]
+def _iter_changes(event_body: dict) -> Iterator[dict]:
+    """Values of all changes, meta may batch several into one delivery."""
+    for entry in event_body.get("entry", []):
+        for change in entry.get("changes", []):
+            yield change.get("value", {})
+
+
+def _get_phone_number(message: dict) -> str:
+    from_phone = message["from"]
     if from_phone.startswith("7"):
         from_phone = "78" + from_phone[1:]
     return from_phone
 
 
-def read_text_message(event_body: dict) -> TextMessage:
-    changes = _get_last_change(event_body)
-    if "messages" in changes and changes["messages"][0]["type"] == "text":
-        from_phone = _get_phone_number(changes)
-        input_text = changes["messages"][0]["text"]["body"]
-        logger.debug(f"received message: {input_text}", extra={"from": from_phone})
-        return TextMessage(from_phone=from_phone, text=input_text)
-    else:
+def _text_message(message: dict) -> Optional[TextMessage]:
+    if message.get("type") != "text":
         return None
+    from_phone = _get_phone_number(message)
+    input_text = message["text"]["body"]
+    logger.debug(f"received message: {input_text}", extra={"from": from_phone})
+    return TextMessage(from_phone=from_phone, text=input_text, id=message.get("id"))
 
 
-def message_was_read(event_body: dict) -> MessageStatus:
-    changes = _get_last_change(event_body)
-    if "statuses" in changes:
-        msg = MessageStatus(
-            status=changes["statuses"][0]["status"],
-            recipient=changes["statuses"][0]["recipient_id"],
-        )
-        return msg
-    else:
+def _media_message(message: dict) -> Optional[MediaMessage]:
+    if message.get("type") not in ["image", "video"]:
         return None
+    phone_number = _get_phone_number(message)
+    media_type = message["type"]
+    media_content = message[media_type]
+    logger.debug(f"received media: {media_content}", extra={"from": phone_number})
+    return MediaMessage(
+        text=media_content.get("caption", ""),
+        media_id=media_content["id"],
+        mime_type=media_content["mime_type"],
+        from_phone=phone_number,
+        id=message.get("id"),
+    )
 
 
-def read_media_message(event_body: dict) -> MediaMessage:
-    changes = _get_last_change(event_body)
-    if "messages" in changes and changes["messages"][0]["type"] in ["image", "video"]:
-        phone_number = _get_phone_number(changes)
-        media_type = changes["messages"][0]["type"]
-        media_content = changes["messages"][0][media_type]
-        logger.debug(f"received media: {media_content}", extra={"from": phone_number})
-        return MediaMessage(
-            text=media_content.get("caption", ""),
-            media_id=media_content["id"],
-            mime_type=media_content["mime_type"],
-            from_phone=phone_number,
-        )
-    else:
-        return None
+def read_messages(event_body: dict) -> list[TextMessage]:
+    """Text and media messages of all changes in the order of delivery.
+
+    Messages of other types such as stickers or locations are skipped.
+    """
+    messages = []
+    for changes in _iter_changes(event_body):
+        for message in changes.get("messages", []):
+            if msg := _text_message(message) or _media_message(message):
+                messages.append(msg)
+    return messages
+
+
+def read_statuses(event_body: dict) -> list[MessageStatus]:
+    """Status updates (sent, delivered, read) of all changes."""
+    return [
+        MessageStatus(status=status["status"], recipient=status["recipient_id"])
+        for changes in _iter_changes(event_body)
+        for status in changes.get("statuses", [])
+    ]
+
+
+def read_text_message(event_body: dict) -> Optional[TextMessage]:
+    """The first text message of the delivery."""
+    for msg in read_messages(event_body):
+        if not isinstance(msg, MediaMessage):
+            return msg
+    return None
+
+
+def message_was_read(event_body: dict) -> Optional[MessageStatus]:
+    """The first status update of the delivery."""
+    statuses = read_statuses(event_body)
+    return statuses[0] if statuses else None
+
+
+def read_media_message(event_body: dict) -> Optional[MediaMessage]:
+    """The first media message of the delivery."""
+    for msg in read_messages(event_body):
+        if isinstance(msg, MediaMessage):
+            return msg
+    return None
 
 
 def retrieve_media_url(media_id: str, headers: dict) -> str:
     """Retrieve media url from cloud api."""
-    resp = requests.get(
-        f"https://graph.facebook.com/v16.0/{media_id}",
+    resp = _get_session().get(
+        f"{GRAPH_URL}/{media_id}",
         headers=headers,
         verify=False,
         timeout=60,
@@ -112,8 +185,75 @@ def retrieve_media_url(media_id: str, headers: dict) -> str:
         return None
 
 
-def send_retry(text, phone_id: str, headers: dict, max_retry: int = 10):
-    i = 0
+def split_text(text: str, limit: int = MAX_TEXT_LENGTH) -> list[str]:
+    """Split text into chunks within the message length limit.
+
+    Chunks end at paragraph breaks if possible, then at line breaks and
+    spaces, so quotes of single parts are not torn apart.
+    """
+    chunks = []
+    while len(text) > limit:
+        for sep in ["\n\n", "\n", " "]:
+            if (cut := text.rfind(sep, 0, limit)) > 0:
+                chunks.append(text[:cut])
+                text = text[cut + len(sep) :]
+                break
+        else:
+            chunks.append(text[:limit])
+            text = text[limit:]
+    chunks.append(text)
+    return chunks
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+def _retry_after(resp: Optional[requests.Response], attempt: int) -> float:
+    """Seconds to wait before the next attempt.
+
+    Rate limit headers are honored, otherwise the delay grows exponentially
+    with full jitter, so concurrent senders do not retry in lockstep.
+    """
+    if resp is not None:
+        if retry_after := resp.headers.get("Retry-After"):
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        if usage := resp.headers.get("X-Business-Use-Case-Usage"):
+            try:
+                minutes = max(
+                    one.get("estimated_time_to_regain_access", 0)
+                    for ones in json.loads(usage).values()
+                    for one in ones
+                )
+            except (ValueError, TypeError, AttributeError):
+                minutes = 0
+            if minutes:
+                return minutes * 60
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def _get_session() -> requests.Session:
+    """Session shared by all senders to reuse connections to the Graph API."""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def connect(timeout: float = 10) -> None:
+    """Open a pooled connection to the Graph API ahead of sending."""
+    _get_session().head(GRAPH_URL, timeout=timeout, allow_redirects=False)
+
+
+def _post_message(
+    text: str, phone_id: str, headers: dict, deadline: float, max_retry: int
+) -> Optional[requests.Response]:
     payload = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
@@ -121,10 +261,14 @@ def send_retry(text, phone_id: str, headers: dict, max_retry: int = 10):
         "type": "text",
         "text": {"preview_url": False, "body": text},
     }
-    while i < max_retry:
+    resp = None
+    for i in range(max_retry):
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
         try:
-            resp = requests.post(
-                URL, headers=headers, json=payload, verify=False, timeout=60
+            resp = _get_session().post(
+                URL, headers=headers, json=payload, verify=False, timeout=timeout
             )
             logger.debug(
                 "POST message",
@@ -135,8 +279,43 @@ def send_retry(text, phone_id: str, headers: dict, max_retry: int = 10):
                     "content": resp.content.decode(),
                 },
             )
-            return resp
-        except Exception as e:
-            logger.warn("error sending message", exc_info=e, extra={"retry": i})
-            time.sleep(1)
-            i += 1
+            if not is_retryable(resp.status_code):
+                return resp
+            logger.warning(
+                "message was not accepted",
+                extra={"status_code": resp.status_code, "retry": i},
+            )
+        except requests.RequestException as e:
+            resp = None
+            logger.warning("error sending message", exc_info=e, extra={"retry": i})
+        delay = _retry_after(resp, i)
+        if time.monotonic() + delay >= deadline:
+            logger.warning("no time left to retry", extra={"delay": delay})
+            break
+        time.sleep(delay)
+    return resp
+
+
+def send_retry(
+    text,
+    phone_id: str,
+    headers: dict,
+    max_retry: int = 10,
+    deadline: float = SEND_DEADLINE,
+) -> Optional[requests.Response]:
+    """Send a text message split into chunks of the allowed length.
+
+    Chunks are sent in order, each one after the previous one was accepted.
+    Connection errors, 429 and 5xx responses are retried until all chunks
+    are sent or deadline seconds have passed.
+
+    Returns:
+        The response to the last chunk sent, None if no response was received.
+    """
+    deadline = time.monotonic() + deadline
+    resp = None
+    for chunk in split_text(text):
+        resp = _post_message(chunk, phone_id, headers, deadline, max_retry)
+        if resp is None or not resp.ok:
+            break
+    return resp
@@ -0,0 +1,160 @@
+"""Bulk ingestion of pdf orders into a partitioned parquet dataset.
+
+Files are matched with a processor by supplier detection and processed in
+parallel. Content hashes of ingested files are recorded in a manifest next
+to the dataset, so re-runs over the full archive only process new files.
+
+The cli runs outside the cloud function, pyarrow is in requirements-dev.txt.
+
+Usage:
+    python -m bot.workers.ingest path/to/orders path/to/dataset --n-jobs 4
+"""
+import argparse
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime as dt
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from bot.log import setup_logger
+from bot.workers import pdf
+
+logger = setup_logger(__name__)
+
+# files starting with an underscore are ignored by parquet readers
+MANIFEST_NAME = "_ingested.jsonl"
+PARTITION_COLS = ["supplier_name"]
+
+
+@dataclass
+class IngestSummary:
+    ingested: int = 0
+    skipped: int = 0
+    failed: int = 0
+    rows: int = 0
+
+
+def file_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    """Sha256 of the file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(dataset: Path) -> dict[str, dict]:
+    """Ingested files by their content hash."""
+    manifest = Path(dataset) / MANIFEST_NAME
+    if not manifest.exists():
+        return {}
+    with open(manifest) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {one["file_hash"]: one for one in records}
+
+
+def _append_manifest(dataset: Path, record: dict) -> None:
+    with open(Path(dataset) / MANIFEST_NAME, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _process_file(path: str) -> tuple[str, pd.DataFrame]:
+    match, res = pdf.process_order(path)
+    return match.processor.__name__, res
+
+
+def _write_rows(dataset: Path, rows: pd.DataFrame, digest: str) -> None:
+    """Write rows of one file, re-writing the same file hash overwrites its parts."""
+    pq.write_to_dataset(
+        pa.Table.from_pandas(rows, preserve_index=False),
+        root_path=str(dataset),
+        partition_cols=PARTITION_COLS,
+        basename_template=f"{digest[:16]}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def ingest(
+    directory: str | Path,
+    dataset: str | Path,
+    n_jobs: int = 1,
+    pattern: str = "*.pdf",
+) -> IngestSummary:
+    """Process new pdf orders from a directory and append them to a dataset.
+
+    Args:
+        directory: directory to search for pdf files recursively
+        dataset: root directory of the parquet dataset
+        n_jobs: number of files to process in parallel
+        pattern: glob pattern of files to ingest
+
+    Returns:
+        Counts of ingested, skipped and failed files and written rows.
+    """
+    dataset = Path(dataset)
+    dataset.mkdir(parents=True, exist_ok=True)
+    seen = set(read_manifest(dataset))
+    summary = IngestSummary()
+
+    todo = {}
+    for path in sorted(Path(directory).rglob(pattern)):
+        digest = file_hash(path)
+        if digest in seen or digest in todo:
+            summary.skipped += 1
+        else:
+            todo[digest] = path
+    logger.info(
+        "found files to ingest", extra=dict(new=len(todo), skipped=summary.skipped)
+    )
+
+    with ProcessPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+        futures = {
+            executor.submit(_process_file, str(path)): digest
+            for digest, path in todo.items()
+        }
+        for future in as_completed(futures):
+            digest = futures[future]
+            path = todo[digest]
+            try:
+                processor, rows = future.result()
+            except Exception as e:
+                logger.error(f"failed to ingest {path}", exc_info=e)
+                summary.failed += 1
+                continue
+            rows["file_hash"] = digest
+            rows["file_name"] = path.name
+            _write_rows(dataset, rows, digest)
+            _append_manifest(
+                dataset,
+                dict(
+                    file_hash=digest,
+                    file_name=str(path),
+                    processor=processor,
+                    rows=len(rows),
+                    ingested_at=dt.now().isoformat(timespec="seconds"),
+                ),
+            )
+            summary.ingested += 1
+            summary.rows += len(rows)
+    return summary
+
+
+def main(args: list[str] = None) -> IngestSummary:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="Directory with supplier pdf orders")
+    parser.add_argument("dataset", help="Root directory of the parquet dataset")
+    parser.add_argument("--n-jobs", type=int, default=1, help="Parallel processes")
+    parser.add_argument("--pattern", default="*.pdf", help="Glob pattern of files")
+    opts = parser.parse_args(args)
+    summary = ingest(opts.directory, opts.dataset, opts.n_jobs, opts.pattern)
+    print(summary)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
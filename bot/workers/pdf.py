@@ -1,19 +1,30 @@
+import dataclasses
+import io
+import itertools
 import re
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Optional
+from pathlib import Path
+from typing import Any, ClassVar, Iterator, Optional
 
 import pandas as pd
 import pdfplumber
 import pydantic
+from pdfminer.pdfpage import PDFPage
 
+from bot.log import setup_logger
 from bot.scheme.enums import Currency
 from bot.scheme.parts import PartOrder
+from bot.utils import layout
+from bot.utils.layout import LabelBox, LayoutCache, PageGeometry, WordIndex
 from bot.utils.parse import format_date
 from bot.utils.table import PandasMixin
 
 TABLE_TYPE = list[PartOrder]
 
+logger = setup_logger(__name__)
+
 
 class CropConfig(pydantic.BaseModel):  # pylint: disable=no-member
     start_after: str = pydantic.Field(..., description="Start after this text")
@@ -33,6 +44,16 @@ class PdfOrderProcessor(ABC, PandasMixin):
 
     file: str
     checksum: Optional[float] = None
+    layout_cache: Optional[LayoutCache] = dataclasses.field(
+        default_factory=LayoutCache.from_env, repr=False
+    )
+    # "table" for pdfplumber's extract_table or "words" to bin words by coordinates
+    engine: str = "table"
+
+    # regex patterns expected in the header of the first page
+    fingerprints: ClassVar[list[str]] = []
+    # bump when crop or column settings change to discard cached geometries
+    layout_version: ClassVar[str] = "1"
 
     @property
     def table_settings(self) -> dict:
@@ -69,44 +90,174 @@ class PdfOrderProcessor(ABC, PandasMixin):
         pdf = pdfplumber.open(self.file)
         return pdf
 
+    def _picklable(self) -> "PdfOrderProcessor":
+        """A copy that can be sent to a worker process to open the pdf itself."""
+        if isinstance(self.file, (str, Path)):
+            return self
+        # pylint: disable=no-member
+        self.file.seek(0)
+        return dataclasses.replace(self, file=io.BytesIO(self.file.read()))
+
+    def _process_pages_parallel(
+        self, num_pages: int, n_jobs: int
+    ) -> list[pd.DataFrame]:
+        """Split pages into contiguous chunks and process them in a process pool."""
+        chunk_size = -(-num_pages // n_jobs)
+        chunks = [
+            list(range(i, min(i + chunk_size, num_pages)))
+            for i in range(0, num_pages, chunk_size)
+        ]
+        proc = self._picklable()
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            results = executor.map(_process_page_chunk, [proc] * len(chunks), chunks)
+            return [t for chunk in results for t in chunk]
+
+    def iter_pages(
+        self, page_indices: Optional[list[int]] = None
+    ) -> Iterator[pd.DataFrame]:
+        """Stream page tables keeping only one parsed page in memory.
+
+        Pages are parsed lazily instead of through ``pdf.pages``, cached layout
+        objects of a page are released once it is processed and the document
+        is closed when the generator is exhausted or closed.
+
+        Args:
+            page_indices: zero-based indices of pages to process, all if None.
+
+        Yields:
+            A dataframe for every page that contains a table.
+        """
+        with self._read_pdf() as pdf:
+            pdf.doc.caching = False
+            for page in _iter_pages_lazy(pdf, page_indices):
+                try:
+                    table = self._process_page_table(page)
+                finally:
+                    page.flush_cache()
+                    page.get_textmap.cache_clear()
+                if table is not None:
+                    yield table
+
     def _process_page_table(self, page) -> pd.DataFrame | None:
-        page = self.crop_page(page)
-        table = page.extract_table(
-            table_settings=self.update_table_settings(page, self.table_settings),
-        )
+        page, table_settings = self.locate_table(page)
+        table = None
+        if self.engine == "words":
+            table = layout.extract_table_words(page, table_settings)
+        if table is None:
+            table = page.extract_table(table_settings=table_settings)
         if not table:
             return None
-        rows = self.parse_table(table)
-        return self.as_table(rows)
+        return self.parse_table_frame(table)
 
     @abstractmethod
     def extract_invoice_date(self, pdf: pdfplumber.PDF) -> str:
         pass
 
-    def run(self):
-        pdf = self._read_pdf()
-        results = []
-        for page in pdf.pages:
-            if (t := self._process_page_table(page)) is not None:
-                results.append(t)
+    def run(self, n_jobs: int = 1):
+        """Extract order items from all pages.
 
-        results = pd.concat(results)
+        Args:
+            n_jobs: number of worker processes to split pages between,
+                pages are processed sequentially in this process if 1.
+
+        Returns:
+            A dataframe with order items in page order.
+        """
+        with self._read_pdf() as pdf:
+            num_pages = _count_pages(pdf)
+            invoice_date = self.extract_invoice_date(pdf)
+
+        if n_jobs > 1 and num_pages > 1:
+            tables = self._process_pages_parallel(num_pages, n_jobs)
+        else:
+            tables = list(self.iter_pages())
+
+        results = pd.concat(tables)
         if self.checksum:
             if (
                 res := round(self.calculate_unit_total(results, vat=self.vat).sum(), 2)
             ) - self.checksum > 1e-3:
                 raise ValueError(f"Parsing has failed: {self.checksum=} and {res=}")
 
-        results["invoice_date"] = self.extract_invoice_date(pdf)
+        results["invoice_date"] = invoice_date
         results["supplier_name"] = self.supplier_name
         results["amount"] = results["price"] * results["quantity"] * (1 + self.vat)
         return results
 
-    def crop_page(self, page):
+    @property
+    def layout_key(self) -> str:
+        return f"{self.supplier_name}-{self.layout_version}"
+
+    def locate_table(self, page) -> tuple[pdfplumber.pdf.Page, dict]:
+        """Crop a page and define table settings.
+
+        Geometry found by searching labels is cached per supplier layout and
+        reused for pages where the labels are found at the same positions.
+        """
+        table_settings = self.table_settings
+        if not (self.crop_settings or self.column_names):
+            return page, table_settings
+
+        if self.layout_cache:
+            geometry = self.layout_cache.match(self.layout_key, page)
+            if geometry and (located := self._apply_geometry(page, geometry)):
+                return located
+
+        words = WordIndex.from_page(page)
+        cropped = self.crop_page(page, words)
+        table_settings = self.update_table_settings(cropped, table_settings, words)
+        if self.layout_cache:
+            geometry = self._learn_geometry(page, cropped, words, table_settings)
+            self.layout_cache.add(self.layout_key, geometry)
+        return cropped, table_settings
+
+    def _learn_geometry(
+        self, page, cropped, words: WordIndex, table_settings: dict
+    ) -> PageGeometry:
+        labels = []
+        if self.crop_settings:
+            start, *_ = words.search(self.crop_settings.start_after)
+            labels.append(LabelBox(**start))
+        for name in dict.fromkeys(col.name for col in self.column_names):
+            res, *_ = words.search(name, bbox=cropped.bbox)
+            labels.append(LabelBox(**res))
+        return PageGeometry(
+            width=page.width,
+            height=page.height,
+            labels=labels,
+            crop_top=cropped.bbox[1] if self.crop_settings else None,
+            vertical_lines=table_settings.get("explicit_vertical_lines", []),
+        )
+
+    def _apply_geometry(
+        self, page, geometry: PageGeometry
+    ) -> Optional[tuple[pdfplumber.pdf.Page, dict]]:
+        """Crop and define columns from a cached geometry, None if the end is missing."""
+        table_settings = self.table_settings
+        if self.crop_settings:
+            end = layout.find_text(
+                page.chars, self.crop_settings.end_before, below=geometry.crop_top
+            )
+            if end is None:
+                return None
+            page = page.crop(
+                [0, geometry.crop_top, page.width, end["top"] - 1], strict=False
+            )
+        if self.column_names:
+            table_settings.update(
+                dict(
+                    vertical_strategy="explicit",
+                    explicit_vertical_lines=list(geometry.vertical_lines),
+                )
+            )
+        return page, table_settings
+
+    def crop_page(self, page, words: Optional[WordIndex] = None):
         """Crops a page if crop_settings are defined."""
         if self.crop_settings:
-            start, *_ = page.search(self.crop_settings.start_after)
-            end, *_ = page.search(self.crop_settings.end_before)
+            words = words or WordIndex.from_page(page)
+            start, *_ = words.search(self.crop_settings.start_after)
+            end, *_ = words.search(self.crop_settings.end_before)
             crop = page.crop(
                 [0, start["bottom"] + 1, page.width, end["top"] - 1], strict=False
             )
@@ -115,15 +266,19 @@ class PdfOrderProcessor(ABC, PandasMixin):
             return page
 
     def update_table_settings(
-        self, page: pdfplumber.pdf.Page, table_settings: dict
+        self,
+        page: pdfplumber.pdf.Page,
+        table_settings: dict,
+        words: Optional[WordIndex] = None,
     ) -> dict:
         """If table column names are provided, then define columns based on test search"""
         if not self.column_names:
             return table_settings
         else:
+            words = words or WordIndex.from_page(page)
             vert_lines = []
             for col in self.column_names:
-                res, *_ = page.search(col.name)
+                res, *_ = words.search(col.name, bbox=page.bbox)
                 vert_lines.append(res[col.side])
             table_settings.update(
                 dict(vertical_strategy="explicit", explicit_vertical_lines=vert_lines)
@@ -136,20 +291,131 @@ class PdfOrderProcessor(ABC, PandasMixin):
             if new_row[i]:
                 prev_row[i] += " " + new_row[i]
 
+    @property
     @abstractmethod
-    def parse_table(self, table) -> TABLE_TYPE:
-        """From pdfplumbers extract_table output to a list of rows and
-        a list of column names."""
+    def column_indices(self) -> dict[str, int]:
+        """Cell index of PartOrder fields in a table row."""
         pass
 
+    def filter_rows(self, rows: list[Any]) -> list[list]:
+        """Only keep meaningful rows of pdfplumbers extract_table output."""
+        return list(filter(lambda x: any(x), rows[1:]))
+
+    def normalize_part_numbers(self, values: pd.Series) -> pd.Series:
+        """Supplier specific cleaning of part numbers before validation."""
+        return values
+
+    def parse_table(self, rows: list[Any]) -> TABLE_TYPE:
+        """From pdfplumbers extract_table output to a list of PartOrder."""
+        return self.to_parts(self.parse_table_frame(rows))
+
+    def parse_table_frame(self, rows: list[Any]) -> pd.DataFrame:
+        """Build PartOrder columns straight from table cells.
+
+        Cleaning and validation run as vectorized string operations, the result
+        matches ``as_table(parse_table(rows))``.
+        """
+        rows = self.filter_rows(rows)
+        columns = list(PartOrder.__fields__)
+        if not rows:
+            return pd.DataFrame(columns=columns)
+        cells = pd.DataFrame(rows, dtype=object)
+        idx = self.column_indices
+        if cells.shape[1] <= max(idx.values()):
+            raise ValueError(
+                f"Table has {cells.shape[1]} columns, expected more than "
+                f"{max(idx.values())}: {rows[0]}"
+            )
+
+        part_number = self.normalize_part_numbers(cells[idx["part_number"]])
+        self._validate(rows, part_number.isna(), "part_number")
+        part_name = cells[idx["part_name"]].str.capitalize()
+        frame = pd.DataFrame(
+            dict(
+                part_number=part_number.str.replace(r"[\W_]+", "", regex=True),
+                part_name=part_name.where(cells[idx["part_name"]].notna(), None),
+                quantity=self._to_number(rows, cells[idx["quantity"]], "quantity"),
+                currency=str(self.currency.value),
+                price=self._to_number(rows, cells[idx["price"]], "price"),
+                discount=0.0,
+            )
+        )
+        if "discount" in idx:
+            frame["discount"] = self._to_number(
+                rows, cells[idx["discount"]], "discount"
+            )
+        frame["quantity"] = frame["quantity"].astype("int64")
+        return frame[columns]
+
+    @classmethod
+    def _to_number(cls, rows: list, values: pd.Series, name: str) -> pd.Series:
+        numbers = pd.to_numeric(cls.fix_numbers(values), errors="coerce")
+        invalid = numbers.isna()
+        if name == "quantity":
+            invalid |= numbers % 1 != 0
+        cls._validate(rows, invalid, name)
+        return numbers.astype(float)
+
+    @staticmethod
+    def _validate(rows: list, invalid: pd.Series, name: str) -> None:
+        if invalid.any():
+            bad = [rows[i] for i in invalid.to_numpy().nonzero()[0]]
+            raise ValueError(f"Invalid {name} in rows: {bad}")
+
+    @staticmethod
+    def to_parts(results: pd.DataFrame) -> TABLE_TYPE:
+        """Per-row PartOrder objects, only built when needed."""
+        fields = list(PartOrder.__fields__)
+        return [PartOrder(**row) for row in results[fields].to_dict(orient="records")]
+
     @staticmethod
     def fix_number(value: str) -> str:
         value = re.sub(",", "", value)
         value = re.sub("\.00$", "", value)
         return value
 
+    @staticmethod
+    def fix_numbers(values: pd.Series) -> pd.Series:
+        """Vectorized fix_number."""
+        values = values.str.strip().str.replace(",", "", regex=False)
+        return values.str.replace(r"\.00$", "", regex=True)
+
+
+def _process_page_chunk(
+    processor: PdfOrderProcessor, page_indices: list[int]
+) -> list[pd.DataFrame]:
+    """Open the pdf in a worker process and process the given pages."""
+    return list(processor.iter_pages(page_indices))
+
+
+def _iter_pages_lazy(
+    pdf: pdfplumber.PDF, page_indices: Optional[list[int]] = None
+) -> Iterator[pdfplumber.page.Page]:
+    """Create page objects one at a time instead of all at once like ``pdf.pages``."""
+    selected = set(page_indices) if page_indices is not None else None
+    doctop = 0
+    for i, page_obj in enumerate(PDFPage.create_pages(pdf.doc)):
+        page = pdfplumber.page.Page(
+            pdf, page_obj, page_number=i + 1, initial_doctop=doctop
+        )
+        doctop += page.height
+        if selected is None or i in selected:
+            yield page
+
+
+def _first_page(pdf: pdfplumber.PDF) -> pdfplumber.page.Page:
+    """The first page without creating the others like ``pdf.pages[0]``."""
+    return next(_iter_pages_lazy(pdf))
+
+
+def _count_pages(pdf: pdfplumber.PDF) -> int:
+    """Number of pages from the page tree, no page objects are kept."""
+    return sum(1 for _ in PDFPage.create_pages(pdf.doc))
+
 
 class PdfOrderEuropeanAutospares(PdfOrderProcessor):
+    fingerprints = [r"european\s+auto\s*spares", r"invoice\s+date", r"invoice\s+no"]
+
     @property
     def supplier_name(self):
         return "European Autospares"
@@ -162,28 +428,18 @@ class PdfOrderEuropeanAutospares(PdfOrderProcessor):
     def currency(self):
         return Currency.aed
 
-    def _process_row(self, row: list) -> list:
+    @property
+    def column_indices(self) -> dict[str, int]:
+        return dict(part_number=1, part_name=2, quantity=4, price=5, discount=6)
+
+    def normalize_part_numbers(self, values: pd.Series) -> pd.Series:
         # Strip manufacturer letter and remove non-word chars
-        part_num = row[1]
-        if m := re.match("(\w\s)(.+(\s\w+)?)", part_num):
-            row[1] = re.sub("\W", "", m.group(2))
-        # create a representation
-        try:
-            part_order = PartOrder(
-                part_number=row[1],
-                part_name=row[2],
-                price=self.fix_number(row[5]),
-                quantity=self.fix_number(row[4]),
-                currency=self.currency,
-                discount=row[6],
-            )
-        except pydantic.ValidationError as e:
-            print(f"{row=}")
-            raise e
-        return part_order
+        stripped = values.str.extract(r"^(\w\s)(.+(\s\w+)?)", expand=True)[1]
+        stripped = stripped.str.replace(r"\W", "", regex=True)
+        return stripped.where(stripped.notna(), values)
 
-    def parse_table(self, rows: list[Any]) -> TABLE_TYPE:
-        """Only keep meaningful rows and extract column names"""
+    def filter_rows(self, rows: list[Any]) -> list[list]:
+        """Only keep meaningful rows and merge second lines"""
         rows = rows[1:]
         rows_filtered = list(filter(lambda x: any(x), rows))
         i = 1
@@ -198,13 +454,13 @@ class PdfOrderEuropeanAutospares(PdfOrderProcessor):
                 rows_filtered.pop(i)
             else:
                 i += 1
-        # strip a manufacturer name
-        rows_filtered = list(map(lambda x: self._process_row(x), rows_filtered))
         return rows_filtered
 
     def extract_invoice_date(self, pdf: pdfplumber.PDF) -> str:
-        page = pdf.pages[0]
+        page = _first_page(pdf)
         tables = page.extract_tables()
+        if len(tables) < 3:
+            raise ValueError(f"Invoice date table not found in {len(tables)} tables")
         [key], [val] = tables[2]
         if key == "Invoice Date":
             return format_date(val, from_format="%m/%d/%Y")
@@ -213,6 +469,8 @@ class PdfOrderEuropeanAutospares(PdfOrderProcessor):
 
 
 class PdfOrderHND(PdfOrderProcessor):
+    fingerprints = [r"\bHND\b", r"document\s+date", r"delivery\s+date"]
+
     @property
     def table_settings(self):
         return dict(
@@ -251,30 +509,13 @@ class PdfOrderHND(PdfOrderProcessor):
     def currency(self):
         return Currency.aed
 
-    def _process_row(self, row: list) -> list:
-        try:
-            part_order = PartOrder(
-                part_number=row[1],
-                part_name=row[2],
-                price=self.fix_number(row[6]),
-                quantity=self.fix_number(row[3]),
-                currency=self.currency,
-                discount=0,
-            )
-        except pydantic.ValidationError as e:
-            print(f"{row=}")
-            raise e
-        return part_order
-
-    def parse_table(self, rows: list[Any]) -> TABLE_TYPE:
-        """Only keep meaningful rows and extract column names"""
-        rows_filtered = list(filter(lambda x: any(x), rows[1:]))
-        rows_filtered = list(map(lambda x: self._process_row(x), rows_filtered))
-        return rows_filtered
+    @property
+    def column_indices(self) -> dict[str, int]:
+        return dict(part_number=1, part_name=2, quantity=3, price=6)
 
     def extract_invoice_date(self, pdf: pdfplumber.PDF) -> str:
-        page = pdf.pages[0]
-        match, *_ = page.search("Document Date")
+        page = _first_page(pdf)
+        match, *_ = WordIndex.from_page(page).search("Document Date")
         crop = page.crop(
             [match["x0"], match["bottom"] + 1, match["x1"], match["bottom"] + 10]
         )
@@ -283,6 +524,8 @@ class PdfOrderHND(PdfOrderProcessor):
 
 
 class PdfOrderHumaidAli(PdfOrderProcessor):
+    fingerprints = [r"humaid\s+ali", r"date\s*:\s*\d{2}/\d{2}/\d{4}"]
+
     @property
     def supplier_name(self):
         return "Humaid Ali Trading"
@@ -295,32 +538,92 @@ class PdfOrderHumaidAli(PdfOrderProcessor):
     def currency(self):
         return Currency.aed
 
-    def _process_row(self, row: list) -> list:
-        try:
-            part_order = PartOrder(
-                part_number=row[0],
-                part_name=row[1],
-                price=self.fix_number(row[3]),
-                quantity=self.fix_number(row[2]),
-                currency=self.currency,
+    @property
+    def column_indices(self) -> dict[str, int]:
+        return dict(part_number=0, part_name=1, quantity=2, price=3)
+
+    def filter_rows(self, rows: list[Any]) -> list[list]:
+        """Only keep meaningful rows after the header lines.
+
+        The header is found by its text, not by position, because pdfplumbers
+        text strategy adds an empty row below it and the words engine does not.
+        """
+        rows = list(filter(lambda x: any(x), rows))
+        qty = self.column_indices["quantity"]
+        return list(
+            itertools.dropwhile(
+                lambda row: not re.fullmatch(r"[\d,.]+", (row[qty] or "").strip()),
+                rows,
             )
-        except pydantic.ValidationError as e:
-            print(f"{row=}")
-            raise e
-        return part_order
-
-    def parse_table(self, rows: list[Any]) -> TABLE_TYPE:
-        """Only keep meaningful rows and extract column names"""
-        rows = rows[2:]
-        rows_filtered = list(filter(lambda x: any(x), rows))
-        rows_filtered = list(map(lambda x: self._process_row(x), rows_filtered))
-        return rows_filtered
+        )
 
     def extract_invoice_date(self, pdf: pdfplumber.PDF) -> str:
-        page = pdf.pages[0]
+        page = _first_page(pdf)
         text = page.extract_text_simple()
         match = re.search("DATE : (\d{2}/\d{2}/\d{4})", text, re.I)
         if match:
             return format_date(match.group(1), "%d/%m/%Y")
         else:
             raise ValueError(f"Date not found in:\n\n{text}")
+
+
+SUPPLIERS = [PdfOrderEuropeanAutospares, PdfOrderHND, PdfOrderHumaidAli]
+
+
+@dataclass
+class SupplierMatch:
+    processor: type[PdfOrderProcessor]
+    confidence: float
+
+
+def read_header_text(file, fraction: float = 0.4) -> str:
+    """Extract text from the top part of the first page only."""
+    with pdfplumber.open(file) as doc:
+        page = next(_iter_pages_lazy(doc, [0]))
+        x0, top, x1, bottom = page.bbox
+        header = page.crop((x0, top, x1, top + (bottom - top) * fraction))
+        return header.extract_text_simple()
+
+
+def detect_supplier(file, header_fraction: float = 0.4) -> list[SupplierMatch]:
+    """Rank processors by the share of their fingerprints found in the header.
+
+    Args:
+        file: path or file object of a pdf order
+        header_fraction: share of the first page height to read text from
+
+    Returns:
+        All processors from SUPPLIERS sorted by confidence, the best first.
+    """
+    text = read_header_text(file, header_fraction)
+    matches = []
+    for processor in SUPPLIERS:
+        found = [re.search(p, text, re.I) is not None for p in processor.fingerprints]
+        matches.append(SupplierMatch(processor, sum(found) / len(found)))
+    return sorted(matches, key=lambda m: m.confidence, reverse=True)
+
+
+def process_order(
+    file, checksum: Optional[float] = None
+) -> tuple[SupplierMatch, pd.DataFrame]:
+    """Detect the supplier of a pdf order and extract its items.
+
+    Candidate processors are tried in the order of detection confidence
+    until one of them succeeds. Processors raise ValueError when a layout
+    does not match, other errors are bugs and are not caught.
+
+    Returns:
+        The supplier match that succeeded and the extracted items.
+    """
+    errors = []
+    for match in detect_supplier(file):
+        try:
+            return match, match.processor(file=file, checksum=checksum).run()
+        except ValueError as e:
+            logger.warning(
+                f"{match.processor.__name__} could not parse {file}, trying the next",
+                exc_info=e,
+                extra={"confidence": match.confidence},
+            )
+            errors.append(f"{match.processor.__name__}: {e!r}")
+    raise ValueError("No processor could parse the order:\n" + "\n".join(errors))
@@ -70,6 +70,12 @@ def _process_pdf_order(vendor_name: str, pdf_order) -> pd.DataFrame:
     return pdf_proc.run()
 
 
+@st.cache_data
+def _detect_pdf_order(pdf_order) -> tuple[str, float, pd.DataFrame]:
+    match, res = pdf.process_order(pdf_order)
+    return match.processor(pdf_order).supplier_name, match.confidence, res
+
+
 with st.sidebar:
     vat = st.number_input(label="НДС", min_value=0.0, max_value=1.0, value=0.05)
     shipping_type = st.radio("Тип доставки", [ShippingType.air, ShippingType.container])
@@ -120,11 +126,18 @@ with tab_orders:
         "Humaid Ali": pdf.PdfOrderHumaidAli,
         "HND": pdf.PdfOrderHND,
     }
-    vendor_name = st.selectbox(label="Поставщик", options=list(suppliers.keys()))
+    auto_detect = "Определить автоматически"
+    vendor_name = st.selectbox(
+        label="Поставщик", options=[auto_detect] + list(suppliers.keys())
+    )
     pdf_order = st.file_uploader("Загрузи пдф файл с заказом")
 
     if pdf_order:
-        res = _process_pdf_order(vendor_name, pdf_order)
+        if vendor_name == auto_detect:
+            supplier_name, confidence, res = _detect_pdf_order(pdf_order)
+            st.info(f"Поставщик: {supplier_name} (уверенность {confidence:.0%})")
+        else:
+            res = _process_pdf_order(vendor_name, pdf_order)
 
         _render_dataframe(
             res,
@@ -1,12 +1,19 @@
+import functools
 import json
 import os
-
-import cv2
-from heyoo import WhatsApp
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
 from bot import wa
 from bot.log import setup_logger
-from bot.utils import parse
+from bot.scheme.enums import Currency, WebhookEvent
+from bot.utils import dedup, work_queue
+
+if TYPE_CHECKING:
+    from bot.scheme.messages import InputMessage, OutputMessage
 
 logger = setup_logger("handler")
 
@@ -14,7 +21,23 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 HEADER_TOKEN = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
 HEADER_JSON = {"Content-Type": "application/json"}
 
-messenger = WhatsApp(WHATSAPP_TOKEN)
+# "queue" acknowledges messages right away and leaves them to the worker
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")
+WORKER_TIME_BUDGET = float(os.getenv("WORKER_TIME_BUDGET", 240))
+JOB_VISIBILITY_TIMEOUT = 300
+MAX_JOB_ATTEMPTS = 3
+# messages of one batched delivery answered at once
+MAX_CONCURRENT_MESSAGES = int(os.getenv("MAX_CONCURRENT_MESSAGES", 4))
+# "progressive" sends priced lines in batches as soon as they are ready,
+# followed by a summary, instead of one message once all lines are priced
+REPLY_MODE = os.getenv("REPLY_MODE", "single")
+PROGRESSIVE_BATCH_SIZE = int(os.getenv("PROGRESSIVE_BATCH_SIZE", 5))
+# lines of one quote priced at once, each scrapes the weight of its part
+PRICING_WORKERS = int(os.getenv("PRICING_WORKERS", 8))
+# recently quoted parts whose weights a warm-up scrapes
+WARMUP_PARTS = int(os.getenv("WARMUP_PARTS", 20))
+# share of status deliveries logged, they are most of the traffic
+STATUS_LOG_SAMPLE_RATE = float(os.getenv("STATUS_LOG_SAMPLE_RATE", 0.01))
 
 
 def _format_final_response(resp, text, phone_number: str):
@@ -39,44 +62,308 @@ def _format_final_response(resp, text, phone_number: str):
         }
 
 
-def _handle_text_message(msg: wa.TextMessage) -> dict:
+def _duplicate(msg: wa.TextMessage) -> dict:
+    logger.info(
+        "duplicate message", extra={"message_id": msg.id, "phone_id": msg.from_phone}
+    )
+    return {
+        "statusCode": 200,
+        "body": "duplicate",
+    }
+
+
+def _answer_message(msg: wa.TextMessage) -> dict:
+    """Reply to the message unless it is processed or in flight already."""
+    store = dedup.from_env()
+    if store is None or msg.id is None:
+        return _reply_message(msg)
+    if not store.claim(msg.id):
+        return _duplicate(msg)
     try:
-        output_data = parse.process_message(msg.text)
+        resp = _reply_message(msg)
+    except BaseException:
+        store.release(msg.id)
+        raise
+    if wa.is_retryable(resp["statusCode"]):
+        # the reply was not delivered, a redelivery may try again
+        store.release(msg.id)
+    else:
+        store.done(msg.id)
+    return resp
+
+
+def _mark_done(msg: wa.TextMessage) -> None:
+    """Remember the message as answered before the reply is complete."""
+    store = dedup.from_env()
+    if store is not None and msg.id is not None:
+        store.done(msg.id)
+
+
+def _image_lines(msg: wa.MediaMessage) -> list["InputMessage"]:
+    """Read the lines of a photo or screenshot of a supplier quote."""
+    from bot.utils import ocr, parse
+
+    if not msg.mime_type.startswith("image/"):
+        raise ValueError("only images of quotes are supported")
+    if (url := wa.retrieve_media_url(msg.media_id, HEADER_TOKEN)) is None:
+        raise RuntimeError(f"unable to retrieve media {msg.media_id}")
+    text = ocr.run_limited(ocr.run_ocr_url, url, HEADER_TOKEN)
+    # ocr also reads headers and totals, only lines with a price are quotes
+    lines = [one for one in parse.parse_input_message(text) if one.price > 0]
+    if not lines:
+        raise ValueError("no quotes found in the image")
+    return lines
+
+
+def _quote(msg: wa.TextMessage) -> list["OutputMessage"]:
+    # the pricing stack is only imported for messages, not for status updates
+    from bot.utils import parse
+
+    if isinstance(msg, wa.MediaMessage):
+        return [parse.prepare_output(one) for one in _image_lines(msg)]
+    return parse.process_message(msg.text)
+
+
+def _send(text: str, msg: wa.TextMessage) -> dict:
+    resp = wa.send_retry(text, msg.from_phone, HEADER_TOKEN | HEADER_JSON, max_retry=10)
+    return _format_final_response(resp, text, msg.from_phone)
+
+
+def _reply_message(msg: wa.TextMessage) -> dict:
+    if REPLY_MODE == "progressive":
+        return _reply_progressive(msg)
+    try:
+        output_data = _quote(msg)
         text = "\n\n".join([out.format() for out in output_data])
 
     except Exception as e:
         logger.error("ERROR in handler", exc_info=e)
         text = f"ERROR: {e}"
 
-    resp = wa.send_retry(text, msg.from_phone, HEADER_TOKEN | HEADER_JSON, max_retry=10)
-    return _format_final_response(resp, text, msg.from_phone)
+    return _send(text, msg)
 
 
-def handler(event, context):
-    logger.info(f"EVENT: {event}")
+def _reply_progressive(msg: wa.TextMessage) -> dict:
+    """Send priced lines in ordered batches as they are ready, then a summary."""
+    from bot.utils import parse
+
+    sent = []
+    try:
+        if isinstance(msg, wa.MediaMessage):
+            lines = _image_lines(msg)
+        else:
+            lines = parse.parse_input_message(msg.text)
+        batches = parse.prepare_outputs(
+            lines, batch_size=PROGRESSIVE_BATCH_SIZE, max_workers=PRICING_WORKERS
+        )
+        for batch in batches:
+            resp = _send("\n\n".join([out.format() for out in batch]), msg)
+            if resp["statusCode"] >= 300:
+                return resp
+            if not sent:
+                # a redelivery would repeat the batches the customer has seen
+                _mark_done(msg)
+            sent.extend(batch)
+        text = parse.format_summary(sent)
+
+    except Exception as e:
+        logger.error("ERROR in handler", exc_info=e, extra={"sent": len(sent)})
+        text = f"ERROR: {e}"
+
+    return _send(text, msg)
+
+
+def _enqueue_message(msg: wa.TextMessage) -> dict:
+    store = dedup.from_env()
+    if store is not None and msg.id is not None and store.status(msg.id):
+        return _duplicate(msg)
+    kind = "media" if isinstance(msg, wa.MediaMessage) else "text"
+    job_id = work_queue.from_env().put({"type": kind, "message": msg.dict()})
+    logger.info("queued message", extra={"job_id": job_id, "phone_id": msg.from_phone})
+    return {
+        "statusCode": 200,
+        "body": "OK",
+    }
+
+
+def _process_job(job: work_queue.Job) -> dict:
+    if job.payload["type"] == "text":
+        return _answer_message(wa.TextMessage(**job.payload["message"]))
+    if job.payload["type"] == "media":
+        return _answer_message(wa.MediaMessage(**job.payload["message"]))
+    raise ValueError(f"unknown job type {job.payload['type']!r}")
+
+
+def worker(event, context) -> dict:
+    """Drain the work queue, meant to be triggered by a timer.
 
-    if challenge := wa.verify_whatsapp_webhook(event):
+    Jobs that fail are retried with a backoff up to MAX_JOB_ATTEMPTS times,
+    the worker stops taking new jobs after WORKER_TIME_BUDGET seconds.
+    """
+    queue = work_queue.from_env()
+    deadline = time.monotonic() + WORKER_TIME_BUDGET
+    processed = failed = 0
+    while time.monotonic() < deadline:
+        if (job := queue.get(visibility_timeout=JOB_VISIBILITY_TIMEOUT)) is None:
+            break
+        try:
+            resp = _process_job(job)
+            if wa.is_retryable(resp["statusCode"]):
+                raise RuntimeError(resp["body"])
+        except Exception as e:
+            failed += 1
+            if job.attempts >= MAX_JOB_ATTEMPTS:
+                logger.error(
+                    "dropped job", exc_info=e, extra={"job_id": job.id, **job.payload}
+                )
+                queue.ack(job)
+            else:
+                logger.warning("retrying job", exc_info=e, extra={"job_id": job.id})
+                queue.nack(job, delay=2**job.attempts)
+        else:
+            processed += 1
+            queue.ack(job)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"processed": processed, "failed": failed}),
+    }
+
+
+def _handle_message(msg: wa.TextMessage) -> dict:
+    try:
+        if WEBHOOK_MODE == "queue":
+            return _enqueue_message(msg)
+        return _answer_message(msg)
+    except Exception as e:
+        logger.error("ERROR in handler", exc_info=e, extra={"message_id": msg.id})
+        return {
+            "statusCode": 500,
+            "body": f"ERROR: {e}",
+        }
+
+
+def _handle_messages(messages: list[wa.TextMessage]) -> list[dict]:
+    """Answer messages concurrently, results are in the order of messages."""
+    if len(messages) <= 1:
+        return [_handle_message(msg) for msg in messages]
+    with ThreadPoolExecutor(min(len(messages), MAX_CONCURRENT_MESSAGES)) as pool:
+        return list(pool.map(_handle_message, messages))
+
+
+def _log_statuses(statuses: list[str]) -> None:
+    if statuses and random.random() < STATUS_LOG_SAMPLE_RATE:
+        logger.info(
+            "message statuses",
+            extra={"statuses": statuses, "sample_rate": STATUS_LOG_SAMPLE_RATE},
+        )
+
+
+def _handle_statuses(raw_body: str) -> dict:
+    """Acknowledge a delivery of status updates only, nothing is done for them."""
+    statuses = wa.read_status_names(raw_body)
+    _log_statuses(statuses)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            [{"type": "status", "statusCode": 200, "status": one} for one in statuses]
+        ),
+    }
+
+
+def _is_warmup(event: dict) -> bool:
+    """A scheduled ping or an explicit warm-up request, not a webhook."""
+    if event.get("warmup"):
+        return True
+    return any(
+        one.get("event_metadata", {}).get("event_type", "").endswith("TimerMessage")
+        for one in event.get("messages", [])
+    )
+
+
+def _warm_up() -> dict:
+    """Load what the first message would wait for, nothing is sent.
+
+    Imports the pricing stack, compiles its patterns, fetches today's
+    exchange rate, opens pooled connections to the Graph API and the
+    scraped hosts and refreshes weights of recently quoted parts.
+    """
+    from bot.services import utils as services
+    from bot.utils import io, parse
+
+    start = time.monotonic()
+    parse.parse_input_message("A0000000000 - 1 + vat 1-2 days")
+    tasks = {
+        "exchange_rate": lambda: services.get_exchange_rate(Currency.aed, "RUB"),
+        "graph_api": wa.connect,
+        "weights": lambda: services.prime_weights(WARMUP_PARTS),
+        **{
+            host: functools.partial(io.connect, host) for host in services.SCRAPER_HOSTS
+        },
+    }
+    results = {}
+    with ThreadPoolExecutor(len(tasks)) as pool:
+        futures = {name: pool.submit(task) for name, task in tasks.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.warning("warm-up step failed", exc_info=e, extra={"step": name})
+                results[name] = f"ERROR: {e}"
+    results["seconds"] = time.monotonic() - start
+    logger.info("warmed up", extra=results)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(results),
+    }
+
+
+def handler(event, context):
+    if _is_warmup(event):
+        return _warm_up()
+    elif challenge := wa.verify_whatsapp_webhook(event):
         logger.info("webhook has been verified", extra={"challenge": challenge})
         return {
             "statusCode": 200,
             "body": challenge,
         }
+    elif (kind := wa.classify_event(event["body"])) == WebhookEvent.statuses:
+        return _handle_statuses(event["body"])
     else:
+        logger.info(
+            "received event", extra={"kind": kind.value, "size": len(event["body"])}
+        )
         body = json.loads(event["body"])
-
-        if msg := wa.read_text_message(body):
-            return _handle_text_message(msg)
-        elif msg := wa.read_media_message(body):
-            raise NotImplementedError("media is not implemented yet.")
-        elif msg := wa.message_was_read(body):
-            logger.info("message was read", extra=msg.dict())
-            return {
-                "statusCode": 200,
-                "body": "OK",
-            }
-        else:
+        messages = wa.read_messages(body)
+        statuses = wa.read_statuses(body)
+        if not messages and not statuses:
             logger.error("unknown event", extra={"body": body})
             return {
                 "statusCode": 403,
                 "body": "unknown event",
             }
+
+        results = [
+            {
+                "id": msg.id,
+                "type": "media" if isinstance(msg, wa.MediaMessage) else "text",
+                **resp,
+            }
+            for msg, resp in zip(messages, _handle_messages(messages))
+        ]
+        _log_statuses([status.status for status in statuses])
+        for status in statuses:
+            results.append({"type": "status", "statusCode": 200, **status.dict()})
+        # any failure makes meta deliver the batch again, answered messages
+        # are skipped then by their ids
+        return {
+            "statusCode": max(one["statusCode"] for one in results),
+            "body": json.dumps(results),
+        }
+
+
+if __name__ == "__main__":
+    # local worker: python index.py [poll seconds]
+    poll = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    while True:
+        logger.info("worker run", extra=json.loads(worker(None, None)["body"]))
+        time.sleep(poll)
@@ -0,0 +1,121 @@
+"""Offline benchmark of MoySklad order imports against a local fake API.
+
+Synthetic invoices are imported with ``import_orders`` into a fresh
+``FakeMoySklad`` with the given latency and the documented rate limits, once
+per number of parallel workers. Wall time, API requests and requests rejected
+with 429 are recorded.
+
+Usage:
+    python -m tests.bench_moysklad --orders 6 --lines 60 --latency 0.05
+"""
+import argparse
+import itertools
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from bot.services import moy_sklad
+from tests import synthetic
+from tests.fake_moysklad import ACCOUNT_NAME, REFERENCE_ENTITIES, FakeMoySklad
+
+CORPUS_DIR = Path(__file__).parent / "data" / "synthetic"
+WORKERS = [1, moy_sklad.MAX_CONCURRENT_REQUESTS]
+
+
+def render_orders(directory: Path, orders: int, lines: int) -> list[Path]:
+    """Invoices of all layouts in turn, existing files are reused."""
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i, render in zip(range(orders), itertools.cycle(synthetic.LAYOUTS.values())):
+        file = directory / f"order_{i}_{lines}.pdf"
+        if not file.exists():
+            render(file, synthetic.make_lines(lines, seed=i), rows_per_page=lines)
+        files.append(file)
+    return files
+
+
+def _sdk(api: FakeMoySklad) -> moy_sklad.MoySkladSDK:
+    sdk = moy_sklad.MoySkladSDK(
+        base_url=api.url,
+        names={
+            "organization": REFERENCE_ENTITIES["organization"][0],
+            "organization/accounts": ACCOUNT_NAME,
+            "store": REFERENCE_ENTITIES["store"][0],
+            "expenseitem": REFERENCE_ENTITIES["expenseitem"][0],
+        },
+        mirror=None,
+        meta_cache=None,
+        limiter=moy_sklad.RateLimiter(),
+    )
+    sdk.init()
+    return sdk
+
+
+def run(
+    orders: int = 6,
+    lines: int = 60,
+    latency: float = 0.05,
+    workers: list[int] = WORKERS,
+    directory: Path = CORPUS_DIR,
+) -> pd.DataFrame:
+    """Import the same invoices with every number of workers.
+
+    Returns:
+        One row per run with the time to parse the invoices, wall time and
+        orders per second of the import, requests sent and requests rejected
+        by the fake api.
+    """
+    files = render_orders(directory, orders, lines)
+    results = []
+    for n in workers:
+        with FakeMoySklad(
+            latency=latency,
+            rate=moy_sklad.RATE_LIMIT,
+            period=moy_sklad.RATE_PERIOD,
+            max_concurrent=moy_sklad.MAX_CONCURRENT_REQUESTS,
+        ) as api:
+            sdk = _sdk(api)
+            start = time.perf_counter()
+            parsed = moy_sklad.read_orders([str(f) for f in files])
+            read_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            futures = moy_sklad.import_orders(sdk, parsed, max_workers=n)
+            seconds = time.perf_counter() - start
+            for future in futures:
+                future.result()
+            results.append(
+                dict(
+                    workers=n,
+                    orders=orders,
+                    lines=lines,
+                    read_seconds=read_seconds,
+                    seconds=seconds,
+                    orders_per_second=orders / seconds,
+                    requests=len(api.requests),
+                    rejected=api.rejected,
+                    supplies=len(api.rows("supply")),
+                    products=len(api.rows("product")),
+                )
+            )
+    return pd.DataFrame(results)
+
+
+def main(args: list[str] = None) -> pd.DataFrame:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=6)
+    parser.add_argument("--lines", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument("--workers", type=int, nargs="+", default=WORKERS)
+    parser.add_argument("--corpus", type=Path, default=CORPUS_DIR)
+    parser.add_argument("--output", type=Path, help="Save results to a csv file")
+    opts = parser.parse_args(args)
+    results = run(opts.orders, opts.lines, opts.latency, opts.workers, opts.corpus)
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    if opts.output:
+        results.to_csv(opts.output, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Scaling benchmark of pdf order processors on synthetic invoices.
+
+Every processor runs in a fresh process on invoices of growing page counts,
+with each table engine and number of page processes. Wall time, pages per
+second and peak memory are recorded, the exponent of time growth between page
+counts makes nonlinear behavior visible.
+
+The order fixtures of tests/test_orders.py are timed with ``--orders``,
+sequential against parallel page processing, files that are missing are
+skipped.
+
+Usage:
+    python -m tests.bench_scaling --pages 1 10 100 1000 --output scaling.csv
+    python -m tests.bench_scaling --orders --jobs 1 2 4 --output orders.csv
+"""
+import argparse
+import itertools
+import math
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from bot.workers import pdf
+from tests import synthetic
+
+CORPUS_DIR = Path(__file__).parent / "data" / "synthetic"
+ORDERS_DIR = Path(__file__).parent / "data" / "orders"
+PAGES = [1, 10, 100, 1000]
+ROWS_PER_PAGE = 20
+# order fixtures of tests/test_orders.py with their checksums
+ORDERS = [
+    (pdf.PdfOrderEuropeanAutospares, "SOW.11833.pdf", 19808.25),
+    (pdf.PdfOrderEuropeanAutospares, "SOW.11544.pdf", 9839.55),
+    (pdf.PdfOrderHumaidAli, "Humaid_Ali_1.pdf", 289.0),
+    (pdf.PdfOrderHumaidAli, "Humaid_Ali_2.pdf", 945),
+    (pdf.PdfOrderHND, "HND_invoice.pdf", 1436.40),
+]
+
+
+def render_corpus(
+    directory: Path = CORPUS_DIR, pages: list[int] = PAGES
+) -> dict[tuple[type, int], Path]:
+    """Render invoices of every layout and size, existing files are reused."""
+    directory.mkdir(parents=True, exist_ok=True)
+    corpus = {}
+    for processor, render in synthetic.LAYOUTS.items():
+        for n in pages:
+            file = directory / f"{processor.__name__}_{n}.pdf"
+            if not file.exists():
+                lines = synthetic.make_lines(n * ROWS_PER_PAGE, seed=n)
+                render(file, lines, rows_per_page=ROWS_PER_PAGE)
+            corpus[(processor, n)] = file
+    return corpus
+
+
+def _max_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_once(
+    processor: type,
+    file: str,
+    engine: str,
+    n_jobs: int = 1,
+    checksum: float = None,
+) -> dict:
+    """Process one file, meant to run in a fresh process to measure memory."""
+    rss_before = _max_rss_mb()
+    start = time.perf_counter()
+    res = processor(file=file, checksum=checksum, engine=engine, layout_cache=None).run(
+        n_jobs=n_jobs
+    )
+    seconds = time.perf_counter() - start
+    return dict(rows=len(res), seconds=seconds, peak_mb=_max_rss_mb() - rss_before)
+
+
+def _run_fresh(*args) -> dict:
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as ex:
+        return ex.submit(_run_once, *args).result()
+
+
+def run(
+    pages: list[int] = PAGES,
+    engines: list[str] = ("table",),
+    directory: Path = CORPUS_DIR,
+    jobs: list[int] = (1,),
+) -> pd.DataFrame:
+    """Benchmark every processor, engine and number of jobs on every invoice size.
+
+    Returns:
+        One row per run with wall time, pages per second, peak memory growth
+        in megabytes and the exponent of time growth from the previous size,
+        which is about 1 for linear scaling.
+    """
+    corpus = render_corpus(directory, pages)
+    results = []
+    for (processor, n), file in corpus.items():
+        for engine, n_jobs in itertools.product(engines, jobs):
+            res = _run_fresh(processor, str(file), engine, n_jobs)
+            results.append(
+                dict(
+                    processor=processor.__name__,
+                    engine=engine,
+                    n_jobs=n_jobs,
+                    pages=n,
+                    pages_per_second=n / res["seconds"],
+                    **res,
+                )
+            )
+    keys = ["processor", "engine", "n_jobs"]
+    results = pd.DataFrame(results).sort_values(keys + ["pages"])
+    prev = results.groupby(keys)[["pages", "seconds"]].shift()
+    results["exponent"] = [
+        math.log(s / ps) / math.log(p / pp) if pp == pp else float("nan")
+        for p, s, pp, ps in zip(
+            results["pages"], results["seconds"], prev["pages"], prev["seconds"]
+        )
+    ]
+    return results.reset_index(drop=True)
+
+
+def run_orders(
+    orders: list[tuple[type, str, float]] = ORDERS,
+    directory: Path = ORDERS_DIR,
+    engines: list[str] = ("table",),
+    jobs: list[int] = (1, 2),
+) -> pd.DataFrame:
+    """Benchmark the order fixtures with every engine and number of jobs.
+
+    Returns:
+        One row per run of a file that exists, with wall time, peak memory
+        growth and the speedup over the run with the fewest jobs.
+    """
+    results = []
+    for processor, name, checksum in orders:
+        file = directory / name
+        if not file.exists():
+            print(f"Skipping {name}, not found in {directory}")
+            continue
+        for engine, n_jobs in itertools.product(engines, jobs):
+            res = _run_fresh(processor, str(file), engine, n_jobs, checksum)
+            results.append(
+                dict(
+                    processor=processor.__name__,
+                    file=name,
+                    engine=engine,
+                    n_jobs=n_jobs,
+                    **res,
+                )
+            )
+    columns = ["processor", "file", "engine", "n_jobs", "rows", "seconds", "peak_mb"]
+    results = pd.DataFrame(results, columns=columns)
+    results = results.sort_values(["file", "engine", "n_jobs"])
+    first = results.groupby(["file", "engine"])["seconds"].transform("first")
+    results["speedup"] = first / results["seconds"]
+    return results.reset_index(drop=True)
+
+
+def main(args: list[str] = None) -> pd.DataFrame:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=PAGES)
+    parser.add_argument("--engines", nargs="+", default=["table", "words"])
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--corpus", type=Path, default=CORPUS_DIR)
+    parser.add_argument("--output", type=Path, help="Save results to a csv file")
+    parser.add_argument(
+        "--orders", action="store_true", help="Time the order fixtures instead"
+    )
+    opts = parser.parse_args(args)
+    if opts.orders:
+        results = run_orders(engines=opts.engines, jobs=opts.jobs)
+    else:
+        results = run(opts.pages, opts.engines, opts.corpus, opts.jobs)
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    if opts.output:
+        results.to_csv(opts.output, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    main()
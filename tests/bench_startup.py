@@ -0,0 +1,121 @@
+"""Cold start benchmark of the webhook entry point.
+
+Every scenario runs in a fresh interpreter, like a new serverless instance.
+Time to import ``index`` and handle the first event, peak memory and the
+heavy modules that got imported are recorded. Memory is read from /proc, so
+the benchmark runs on linux only.
+
+Usage:
+    python -m tests.bench_startup --repeat 5 --output startup.csv
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).parent.parent
+# modules only the media, ocr and pdf paths need
+HEAVY_MODULES = ["cv2", "numpy", "bs4", "heyoo", "pandas", "pdfplumber", "pytesseract"]
+STATUS_EVENT = {
+    "queryStringParameters": {},
+    "body": json.dumps(
+        {
+            "object": "whatsapp_business_account",
+            "entry": [
+                {
+                    "id": "1",
+                    "changes": [
+                        {
+                            "value": {
+                                "messaging_product": "whatsapp",
+                                "statuses": [
+                                    {
+                                        "id": "wamid.1",
+                                        "status": "delivered",
+                                        "recipient_id": "9715",
+                                    }
+                                ],
+                            },
+                            "field": "messages",
+                        }
+                    ],
+                }
+            ],
+        }
+    ),
+}
+SCENARIOS = {
+    "import": "",
+    "status": f"index.handler({STATUS_EVENT!r}, None)",
+    # the pricing stack a text quote loads before any request is sent
+    "text": "from bot.utils import parse",
+}
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import index
+{scenario}
+seconds = time.perf_counter() - start
+
+def peak_rss_mb():
+    # ru_maxrss would include the memory of the parent before exec
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+print(json.dumps(dict(
+    seconds=seconds,
+    rss_mb=peak_rss_mb(),
+    heavy_modules=[m for m in {heavy!r} if m in sys.modules],
+)))
+"""
+
+
+def measure(scenario: str) -> dict:
+    """Start a fresh interpreter, import index and run the scenario."""
+    script = _SCRIPT.format(scenario=SCENARIOS[scenario], heavy=HEAVY_MODULES)
+    out = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return dict(scenario=scenario, **json.loads(out.splitlines()[-1]))
+
+
+def run(scenarios: list[str] = list(SCENARIOS), repeat: int = 5) -> pd.DataFrame:
+    """Median time and memory of every scenario over repeated cold starts."""
+    results = []
+    for scenario in scenarios:
+        runs = pd.DataFrame([measure(scenario) for _ in range(repeat)])
+        results.append(
+            dict(
+                scenario=scenario,
+                seconds=runs["seconds"].median(),
+                rss_mb=runs["rss_mb"].median(),
+                heavy_modules=",".join(runs["heavy_modules"].iloc[0]),
+            )
+        )
+    return pd.DataFrame(results)
+
+
+def main(args: list[str] = None) -> pd.DataFrame:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="Save results to a csv file")
+    opts = parser.parse_args(args)
+    results = run(opts.scenarios, opts.repeat)
+    print(results.to_string(index=False, float_format="{:.3f}".format))
+    if opts.output:
+        results.to_csv(opts.output, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import io
+
+import cv2
+import numpy as np
+import pytest
+import requests
+
+# pylint: disable=no-member
+
+
+def quote_image(width: int, height: int, ext: str = ".jpg") -> bytes:
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    cv2.putText(
+        img, "A1678853300 - 900 + vat", (50, 200), cv2.FONT_HERSHEY_SIMPLEX, 4, 0, 8
+    )
+    return cv2.imencode(ext, img)[1].tobytes()
+
+
+def image_response(content: bytes, length: bool = True) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.raw = io.BytesIO(content)
+    if length:
+        resp.headers["Content-Length"] = str(len(content))
+    return resp
+
+
+@pytest.fixture
+def clock(mocker):
+    """Monotonic time advanced by sleeps only."""
+    clock = mocker.patch("time.monotonic", return_value=100.0)
+    mocker.patch(
+        "time.sleep",
+        side_effect=lambda s: clock.configure_mock(return_value=clock() + s),
+    )
+    return clock
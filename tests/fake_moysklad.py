@@ -0,0 +1,265 @@
+"""Local stand-in for the MoySklad JSON API.
+
+Implements the endpoints ``bot.services.moy_sklad`` uses: lists with search,
+filters and pagination, single and array POST, PUT and the organization
+accounts relation. Requests can be delayed and limited like the real API,
+which answers 429 when a client exceeds its request rate or concurrency.
+
+Usage:
+    with FakeMoySklad(latency=0.05) as api:
+        sdk = MoySkladSDK(base_url=api.url, ...)
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+REFERENCE_ENTITIES = {
+    "organization": ["Fake Trading LLC"],
+    "counterparty": ["European Autospares", "HND", "Humaid Ali Trading"],
+    "currency": ["AED", "USD", "RUB"],
+    "store": ["Al Fada Dubai"],
+    "expenseitem": ["Закупка товаров"],
+}
+# accounts have no name, the sdk finds them by the bank name
+ACCOUNT_NAME = "Fake Bank"
+
+
+class FakeMoySklad:
+    """In-memory MoySklad served over http from a background thread.
+
+    Args:
+        latency: seconds added to every response
+        rate: requests allowed per period, unlimited if None
+        period: length of the rate limit window in seconds
+        max_concurrent: requests served at once, more are answered with 429
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate: Optional[int] = None,
+        period: float = 3.0,
+        max_concurrent: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.rate = rate
+        self.period = period
+        self.max_concurrent = max_concurrent
+        self.entities: dict[str, dict[str, dict]] = defaultdict(dict)
+        self.requests: list[tuple[str, str]] = []
+        self.rejected = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._in_flight = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        for entity, names in REFERENCE_ENTITIES.items():
+            for name in names:
+                self.create(entity, dict(name=name))
+        organization = next(iter(self.entities["organization"].values()))
+        self.create(
+            f"organization/{organization['id']}/accounts",
+            dict(accountNumber="AE000000000000000000001", bankName=ACCOUNT_NAME),
+        )
+
+    def start(self) -> "FakeMoySklad":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def rows(self, entity: str) -> list[dict]:
+        return list(self.entities[entity].values())
+
+    def _now(self) -> str:
+        return dt.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+    def create(self, entity: str, data: dict) -> dict:
+        row_id = f"{next(self._ids):08d}-0000-0000-0000-000000000000"
+        href = f"{self.url}/entity/{entity}/{row_id}"
+        row = dict(
+            data,
+            id=row_id,
+            meta=dict(href=href, type=entity.split("/")[-1]),
+            updated=self._now(),
+        )
+        if entity == "supply":
+            row["name"] = f"{len(self.entities[entity]) + 1:05d}"
+        self.entities[entity][row_id] = row
+        return row
+
+    def update(self, entity: str, row_id: str, data: dict) -> dict:
+        row = self.entities[entity][row_id]
+        row.update({k: v for k, v in data.items() if k not in ["id", "meta"]})
+        row["updated"] = self._now()
+        return row
+
+    def list(self, entity: str, query: dict) -> dict:
+        rows = self.rows(entity)
+        if search := query.get("search"):
+            rows = [
+                r
+                for r in rows
+                if any(search in str(r.get(k, "")) for k in ["name", "code", "article"])
+            ]
+        if filters := query.get("filter"):
+            rows = [r for r in rows if _matches(r, filters)]
+        limit = int(query.get("limit", 1000))
+        offset = int(query.get("offset", 0))
+        return dict(
+            meta=dict(size=len(rows), limit=limit, offset=offset),
+            rows=rows[offset : offset + limit],
+        )
+
+    def _admit(self) -> bool:
+        """Account the request against the limits, False if it is rejected."""
+        now = time.monotonic()
+        while self._recent and self._recent[0] <= now - self.period:
+            self._recent.popleft()
+        if (self.rate and len(self._recent) >= self.rate) or (
+            self.max_concurrent and self._in_flight >= self.max_concurrent
+        ):
+            self.rejected += 1
+            return False
+        self._recent.append(now)
+        self._in_flight += 1
+        return True
+
+    def _retry_after_ms(self) -> int:
+        if self._recent and self.rate and len(self._recent) >= self.rate:
+            return int((self._recent[0] + self.period - time.monotonic()) * 1000) + 1
+        return 100
+
+    def handle(self, method: str, url: str, body) -> tuple[int, dict, object]:
+        """Answer a request with a status, headers and a json body."""
+        parsed = urlparse(url)
+        path = parsed.path.strip("/")
+        with self._lock:
+            self.requests.append((method, path))
+            if not self._admit():
+                headers = {
+                    "X-RateLimit-Limit": str(self.rate or 0),
+                    "X-Lognex-Retry-TimeInterval": str(int(self.period * 1000)),
+                    "X-Lognex-Retry-After": str(self._retry_after_ms()),
+                }
+                return 429, headers, dict(errors=[dict(error="Превышен лимит")])
+        try:
+            time.sleep(self.latency)
+            with self._lock:
+                return 200, {}, self._route(method, path, parsed.query, body)
+        except KeyError as e:
+            return 404, {}, dict(errors=[dict(error=f"Не найдено: {e}")])
+        except ValueError as e:
+            return 400, {}, dict(errors=[dict(error=str(e))])
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _route(self, method: str, path: str, query: str, body):
+        if not (match := re.fullmatch(r"entity/([\w/-]+?)(?:/([0-9a-f-]{36}))?", path)):
+            raise KeyError(path)
+        entity, row_id = match.groups()
+        query = {k: v[0] for k, v in parse_qs(query).items()}
+        if method == "GET" and row_id is None:
+            return self.list(entity, query)
+        if method == "GET":
+            return self.entities[entity][row_id]
+        if method == "PUT" and row_id:
+            return self.update(entity, row_id, body)
+        if method == "POST" and row_id is None:
+            if isinstance(body, list):
+                return [self._save(entity, one) for one in body]
+            self._check_references(body)
+            return self.create(entity, body)
+        raise KeyError(f"{method} {path}")
+
+    def _save(self, entity: str, data: dict) -> dict:
+        """Array POST item, entities with meta are updated."""
+        try:
+            if "meta" in data:
+                row_id = data["meta"]["href"].rstrip("/").split("/")[-1]
+                return self.update(entity, row_id, data)
+            self._check_references(data)
+            return self.create(entity, data)
+        except (KeyError, ValueError) as e:
+            return dict(errors=[dict(error=repr(e))])
+
+    def _check_references(self, data: dict) -> None:
+        """Referenced entities must exist like in the real API."""
+        hrefs = re.findall(r'"href": "([^"]+)"', json.dumps(data))
+        for href in hrefs:
+            path = urlparse(href).path.strip("/").split("/")
+            entity, row_id = "/".join(path[1:-1]), path[-1]
+            if row_id not in self.entities.get(entity, {}):
+                raise ValueError(f"Неизвестная ссылка {href}")
+
+
+def _matches(row: dict, filters: str) -> bool:
+    """Filters of the same field are joined with OR, different fields with AND."""
+    groups = defaultdict(list)
+    for one in filters.split(";"):
+        field, op, value = re.match(r"(\w+)(>=|<=|=)(.*)", one).groups()
+        groups[field].append((op, value))
+    for field, conditions in groups.items():
+        actual = str(row.get(field, ""))
+        if not any(
+            (op == "=" and actual == value)
+            or (op == ">=" and actual >= value)
+            or (op == "<=" and actual <= value)
+            for op, value in conditions
+        ):
+            return False
+    return True
+
+
+def _handler(api: FakeMoySklad) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, without this every
+        # response waits for a delayed ack
+        disable_nagle_algorithm = True
+
+        def _respond(self, method: str):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, headers, data = api.handle(method, self.path, body)
+            content = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def do_PUT(self):
+            self._respond("PUT")
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,231 @@
+"""Render synthetic supplier invoices in the layouts of the pdf workers.
+
+Real supplier pdfs can not be shared in the repository, so tests and
+benchmarks use generated invoices that mimic the table layouts
+``bot.workers.pdf`` is tuned for.
+"""
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from bot.workers import pdf
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+FONT = "Helvetica"
+FONT_SIZE = 8
+ROW_HEIGHT = 14
+
+
+@dataclass
+class InvoiceLine:
+    part_number: str
+    part_name: str
+    quantity: int
+    price: float
+
+
+def make_lines(n: int, seed: int = 0) -> list[InvoiceLine]:
+    """Generate random invoice lines."""
+    rnd = random.Random(seed)
+    names = ["BRAKE PAD", "OIL FILTER", "BUMPER BRACKET", "HEAD LAMP", "WIPER BLADE"]
+    lines = []
+    for _ in range(n):
+        lines.append(
+            InvoiceLine(
+                part_number="A" + "".join(rnd.choices("0123456789", k=10)),
+                part_name=rnd.choice(names),
+                quantity=rnd.randint(1, 20),
+                price=rnd.randint(1000, 500000) / 100,
+            )
+        )
+    return lines
+
+
+def checksum(lines: list[InvoiceLine], vat: float = 0.05) -> float:
+    """Invoice total including vat."""
+    return round(sum(one.quantity * one.price for one in lines) * (1 + vat), 2)
+
+
+def _chunks(lines: list, size: int):
+    for i in range(0, len(lines), size):
+        yield lines[i : i + size]
+
+
+def _money(value: float) -> str:
+    return f"{value:,.2f}"
+
+
+def _y(top: float) -> float:
+    """Convert a distance from the top of the page into reportlab coordinates."""
+    return PAGE_HEIGHT - top
+
+
+def _text(c: canvas.Canvas, x: float, top: float, value: str, right: bool = False):
+    """Draw a text with its top edge at ``top``."""
+    baseline = _y(top + FONT_SIZE)
+    if right:
+        c.drawRightString(x, baseline, value)
+    else:
+        c.drawString(x, baseline, value)
+
+
+def _hline(c: canvas.Canvas, x0: float, x1: float, top: float):
+    c.line(x0, _y(top), x1, _y(top))
+
+
+def _vline(c: canvas.Canvas, x: float, top: float, bottom: float):
+    c.line(x, _y(top), x, _y(bottom))
+
+
+def _box(c: canvas.Canvas, x0: float, top: float, rows: list[str], width: float):
+    """A single column table drawn with lines."""
+    bottom = top + ROW_HEIGHT * len(rows)
+    c.rect(x0, _y(bottom), width, bottom - top)
+    for i, value in enumerate(rows):
+        if i:
+            _hline(c, x0, x0 + width, top + i * ROW_HEIGHT)
+        _text(c, x0 + 3, top + i * ROW_HEIGHT + 3, value)
+
+
+def render_european_autospares(
+    path: str | Path,
+    lines: list[InvoiceLine],
+    rows_per_page: int = 20,
+    invoice_date: str = "04/26/2023",
+) -> Path:
+    """Lines-and-text layout with wrapped descriptions and an invoice date box."""
+    borders = [30, 55, 190, 360, 400, 440, 500, 530, 570]
+    c = canvas.Canvas(str(path), pagesize=A4)
+    c.setFont(FONT, FONT_SIZE)
+    pages = list(_chunks(lines, rows_per_page)) or [[]]
+    n = 0
+    for page_no, chunk in enumerate(pages):
+        c.setFont(FONT, FONT_SIZE)
+        if page_no == 0:
+            _text(c, 30, 20, "EUROPEAN AUTOSPARES LLC")
+            _box(c, 30, 40, ["Customer", "Cash Customer"], 150)
+            _box(c, 220, 40, ["Invoice No", "SOW.10001"], 150)
+            _box(c, 410, 40, ["Invoice Date", invoice_date], 150)
+        top = 120
+        headers = ["No.", "Part Number", "Description", "Unit", "Qty", "Price"]
+        headers += ["Disc", "Amount"]
+        for x, value in zip(borders, headers):
+            _text(c, x + 2, top + 3, value)
+        row_top = top + ROW_HEIGHT
+        for one in chunk:
+            n += 1
+            name, *rest = one.part_name.split(" ", maxsplit=1)
+            part = (
+                f"M {one.part_number[:4]} {one.part_number[4:7]} {one.part_number[7:]}"
+            )
+            values = [str(n), part, name, "PCS", f"{one.quantity}.00"]
+            values += [_money(one.price), "0", _money(one.price * one.quantity)]
+            for x, value in zip(borders, values):
+                _text(c, x + 2, row_top + 3, value)
+            row_top += ROW_HEIGHT
+            if rest:
+                # description printed on a second line
+                _text(c, borders[2] + 2, row_top + 3, f"{rest[0]} GENUINE")
+                row_top += ROW_HEIGHT
+        _hline(c, borders[0], borders[-1], top)
+        _hline(c, borders[0], borders[-1], top + ROW_HEIGHT)
+        _hline(c, borders[0], borders[-1], row_top)
+        for x in borders:
+            _vline(c, x, top, row_top)
+        c.showPage()
+    c.save()
+    return Path(path)
+
+
+def render_hnd(
+    path: str | Path,
+    lines: list[InvoiceLine],
+    rows_per_page: int = 20,
+    invoice_date: str = "21/06/23",
+) -> Path:
+    """Fully ruled rows cropped between two labels and columns found by headers."""
+    columns = [
+        ("Sr. No.", 30, False),
+        ("Item Code", 70, False),
+        ("Description", 170, False),
+        ("Quantity", 300, False),
+        ("UoM", 345, False),
+        ("Loc", 375, False),
+        ("Price", 450, True),
+        ("Tax 5%", 500, True),
+        ("Total", 565, True),
+    ]
+    c = canvas.Canvas(str(path), pagesize=A4)
+    pages = list(_chunks(lines, rows_per_page)) or [[]]
+    n = 0
+    for chunk in pages:
+        c.setFont(FONT, FONT_SIZE)
+        _text(c, 30, 40, "HND AUTO SPARE PARTS")
+        _text(c, 400, 40, "Document Date")
+        _text(c, 402, 40 + FONT_SIZE + 2, invoice_date)
+        _text(c, 30, 80, "Delivery Date")
+        top = 100
+        for name, x, right in columns:
+            _text(c, x, top + 3, name, right=right)
+        row_top = top + ROW_HEIGHT
+        _hline(c, 25, 570, top)
+        _hline(c, 25, 570, row_top)
+        for one in chunk:
+            n += 1
+            tax = one.price * one.quantity * 0.05
+            values = [str(n), one.part_number, one.part_name, str(one.quantity)]
+            values += ["PCS", "A1", _money(one.price), _money(tax)]
+            values += [_money(one.price * one.quantity + tax)]
+            for (_, x, right), value in zip(columns, values):
+                _text(c, x - 1 if right else x, row_top + 3, value, right=right)
+            row_top += ROW_HEIGHT
+            _hline(c, 25, 570, row_top)
+        _text(c, 400, row_top + 10, "Order Subtotal")
+        c.showPage()
+    c.save()
+    return Path(path)
+
+
+def render_humaid_ali(
+    path: str | Path,
+    lines: list[InvoiceLine],
+    rows_per_page: int = 20,
+    invoice_date: str = "14/04/2023",
+) -> Path:
+    """Lines-and-text layout with a header row and an inline date."""
+    borders = [30, 150, 350, 400, 480, 570]
+    c = canvas.Canvas(str(path), pagesize=A4)
+    pages = list(_chunks(lines, rows_per_page)) or [[]]
+    for chunk in pages:
+        c.setFont(FONT, FONT_SIZE)
+        _text(c, 30, 40, "HUMAID ALI TRADING")
+        _text(c, 400, 40, f"DATE : {invoice_date}")
+        top = 100
+        headers = ["PART NO", "DESCRIPTION", "QTY", "UNIT PRICE", "AMOUNT"]
+        for x, value in zip(borders, headers):
+            _text(c, x + 2, top + 3, value)
+        row_top = top + ROW_HEIGHT
+        for one in chunk:
+            values = [one.part_number, one.part_name, str(one.quantity)]
+            values += [_money(one.price), _money(one.price * one.quantity)]
+            for x, value in zip(borders, values):
+                _text(c, x + 2, row_top + 3, value)
+            row_top += ROW_HEIGHT
+        _hline(c, borders[0], borders[-1], top)
+        _hline(c, borders[0], borders[-1], row_top)
+        for x in borders:
+            _vline(c, x, top, row_top)
+        c.showPage()
+    c.save()
+    return Path(path)
+
+
+# processor of every rendered layout
+LAYOUTS = {
+    pdf.PdfOrderEuropeanAutospares: render_european_autospares,
+    pdf.PdfOrderHND: render_hnd,
+    pdf.PdfOrderHumaidAli: render_humaid_ali,
+}
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.utils.dedup import DedupStore
+
+
+def test_claim(tmp_path, mocker):
+    store = DedupStore(tmp_path / "dedup.sqlite", ttl=100, in_flight_ttl=10)
+    assert store.claim("wamid.1")
+    assert store.status("wamid.1") == "in_flight"
+    assert not store.claim("wamid.1")
+
+    # a failed attempt can be repeated
+    store.release("wamid.1")
+    assert store.claim("wamid.1")
+    store.done("wamid.1")
+    assert not store.claim("wamid.1")
+    store.release("wamid.1")
+    assert store.status("wamid.1") == "done"
+
+    now = mocker.patch("time.time", return_value=1e10)
+    assert store.claim("wamid.1")
+    # the claim of a crashed process expires
+    now.return_value += 10
+    assert store.claim("wamid.1")
+    assert store.purge() == 0
+    now.return_value += 10
+    assert store.purge() == 1
+
+
+def test_claim_concurrent(tmp_path):
+    stores = [DedupStore(tmp_path / "dedup.sqlite") for _ in range(4)]
+    with ThreadPoolExecutor(len(stores)) as pool:
+        claims = list(pool.map(lambda s: s.claim("wamid.1"), stores * 5))
+    assert claims.count(True) == 1
@@ -1,9 +1,20 @@
 import json
+import subprocess
+import sys
+import time
 from pathlib import Path
 
 import pytest
+import requests
 
+import index
 from bot import wa
+from bot.scheme.enums import WebhookEvent
+from bot.scheme.messages import InputMessage, OutputMessage
+from bot.utils.dedup import DedupStore
+from bot.utils.work_queue import SqliteQueue
+from tests import bench_startup
+from tests.conftest import image_response, quote_image
 
 TEST_DATA_DIR = Path(__file__).parent / "data" / "requests"
 
@@ -42,6 +53,40 @@ def message_text():
     }
 
 
+@pytest.fixture(scope="module")
+def message_batch():
+    def message(i, text):
+        return {
+            "from": "9715",
+            "id": f"wamid.{i}",
+            "type": "text",
+            "text": {"body": text},
+        }
+
+    def change(messages=(), statuses=()):
+        value = {
+            "messaging_product": "whatsapp",
+            "metadata": {"phone_number_id": "108"},
+        }
+        if messages:
+            value["messages"] = list(messages)
+        if statuses:
+            value["statuses"] = list(statuses)
+        return {"value": value, "field": "messages"}
+
+    status = {"id": "wamid.0", "status": "read", "recipient_id": "9715"}
+    sticker = {"from": "9715", "id": "wamid.4", "type": "sticker", "sticker": {}}
+    body = {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {"id": "1", "changes": [change([message(1, "a"), message(2, "b")])]},
+            {"id": "2", "changes": [change(statuses=[status]), change([sticker])]},
+            {"id": "3", "changes": [change([message(3, "c")])]},
+        ],
+    }
+    return {"queryStringParameters": {}, "body": json.dumps(body)}
+
+
 @pytest.fixture(scope="module")
 def message_media_image():
     return {
@@ -80,6 +125,7 @@ def test_message(message_text, message_read, message_media_image):
     msg = wa.read_text_message(json.loads(message_text["body"]))
     assert msg.from_phone == "9715"
     assert msg.text == "hello world"
+    assert msg.id == "wamid.HBgM"
 
     msg = wa.read_text_message(json.loads(message_read["body"]))
     assert msg is None
@@ -114,6 +160,357 @@ def test_media_message(message_media_image, message_media_video, message_text):
     assert msg is None
 
 
+def test_classify_event(message_read, message_text, message_batch):
+    assert wa.classify_event(message_read["body"]) == WebhookEvent.statuses
+    assert wa.classify_event(message_text["body"]) == WebhookEvent.messages
+    # a batch with messages and statuses takes the full path
+    assert wa.classify_event(message_batch["body"]) == WebhookEvent.messages
+    assert wa.classify_event('{"entry": []}') == WebhookEvent.unknown
+
+    text = json.dumps({"statuses": [], "status": "read"})
+    body = json.dumps({"entry": [{"changes": [{"value": {"messages": [text]}}]}]})
+    assert wa.classify_event(body) == WebhookEvent.messages
+    assert wa.read_status_names(message_read["body"]) == ["read"]
+
+
+def test_status_fast_path(message_read):
+    """Status deliveries are acknowledged without loading the pricing stack."""
+    script = (
+        "import json, sys, index;"
+        f"resp = index.handler({message_read!r}, None);"
+        "print(json.dumps(resp));"
+        "print('bot.utils.parse' in sys.modules)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.splitlines()
+    assert json.loads(out[0]) == {
+        "statusCode": 200,
+        "body": json.dumps([{"type": "status", "statusCode": 200, "status": "read"}]),
+    }
+    assert out[1] == "False"
+
+
+def _response(status: int, headers: dict = None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = b"{}"
+    resp.headers.update(headers or {})
+    return resp
+
+
+def test_split_text():
+    assert wa.split_text("short") == ["short"]
+    quotes = [f"A{i:04d}\nЦена: 100 руб." for i in range(3)]
+    assert wa.split_text("\n\n".join(quotes), limit=30) == quotes
+    assert wa.split_text("a" * 25 + "\nb", limit=10) == [
+        "a" * 10,
+        "a" * 10,
+        "a" * 5 + "\nb",
+    ]
+
+
+def test_send_retry(clock, mocker):
+    post = mocker.patch.object(
+        requests.Session,
+        "post",
+        side_effect=[
+            requests.ConnectionError(),
+            _response(429, {"Retry-After": "7"}),
+            _response(503),
+            _response(200),
+            _response(200),
+        ],
+    )
+    text = "a" * 4000 + "\n\n" + "b" * 100
+    resp = wa.send_retry(text, "9715", {})
+    assert resp.status_code == 200
+    # chunks are sent in order once the previous one was accepted
+    assert [c.kwargs["json"]["text"]["body"] for c in post.call_args_list] == [
+        "a" * 4000
+    ] * 4 + ["b" * 100]
+    sleeps = [c.args[0] for c in time.sleep.call_args_list]
+    assert len(sleeps) == 3
+    assert sleeps[1] == 7
+    assert 0 <= sleeps[2] <= wa.BACKOFF_BASE * 4
+
+    # client errors are not retried
+    post.side_effect = [_response(400)]
+    assert wa.send_retry("text", "9715", {}).status_code == 400
+
+
+def test_send_retry_deadline(clock, mocker):
+    post = mocker.patch.object(
+        requests.Session,
+        "post",
+        return_value=_response(
+            429,
+            {
+                "X-Business-Use-Case-Usage": json.dumps(
+                    {"1": [{"type": "whatsapp", "estimated_time_to_regain_access": 1}]}
+                )
+            },
+        ),
+    )
+    resp = wa.send_retry("text", "9715", {}, deadline=150)
+    assert resp.status_code == 429
+    # a minute to wait after each attempt, the third would end after the deadline
+    assert post.call_count == 3
+    assert clock() == 220
+
+
+@pytest.mark.parametrize("scenario", bench_startup.SCENARIOS)
+def test_cold_start(scenario):
+    """Heavy modules are only imported by the paths that need them."""
+    result = bench_startup.measure(scenario)
+    assert result["heavy_modules"] == []
+    # generous budgets, opencv alone takes more than the memory one
+    assert result["seconds"] < 2
+    assert result["rss_mb"] < 60
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        {"warmup": True},
+        {
+            "messages": [
+                {
+                    "event_metadata": {
+                        "event_type": "yandex.cloud.events.serverless.triggers.TimerMessage"
+                    }
+                }
+            ]
+        },
+    ],
+)
+def test_warm_up(event, mocker):
+    from bot.services import utils as services
+
+    services._get_exchange_rate.cache_clear()
+    request = mocker.patch(
+        "bot.services.utils.make_request",
+        side_effect=lambda url, params: {
+            "rates": {params["start_date"]: {"RUB": 20.0}}
+        },
+    )
+    graph = mocker.patch("bot.wa.connect", return_value=None)
+    connect = mocker.patch("bot.utils.io.connect", return_value=None)
+    mocker.patch("bot.services.utils.prime_weights", return_value=2)
+    send = mocker.patch("bot.wa.send_retry")
+
+    resp = index.handler(event, None)
+    assert resp["statusCode"] == 200
+    results = json.loads(resp["body"])
+    assert results["exchange_rate"] == 20.0
+    assert results["weights"] == 2
+    graph.assert_called_once()
+    assert {c.args[0] for c in connect.call_args_list} == set(services.SCRAPER_HOSTS)
+    send.assert_not_called()
+
+    # the rate is cached for the first message
+    services.get_exchange_rate("AED", "RUB")
+    assert request.call_count == 1
+    services._get_exchange_rate.cache_clear()
+
+
+@pytest.fixture
+def dedup_store(tmp_path, mocker):
+    store = DedupStore(tmp_path / "dedup.sqlite")
+    mocker.patch("bot.utils.dedup.from_env", return_value=store)
+    return store
+
+
+def test_duplicate_message(message_text, dedup_store, mocker):
+    process = mocker.patch(
+        "bot.utils.parse.process_message",
+        return_value=[OutputMessage(price=100, lead_days=2, part_number="A0001")],
+    )
+    send = mocker.patch(
+        "bot.wa.send_retry", return_value=mocker.Mock(status_code=200, content=b"{}")
+    )
+    assert index.handler(message_text, None)["statusCode"] == 200
+    assert index.handler(message_text, None) == {
+        "statusCode": 200,
+        "body": json.dumps(
+            [
+                {
+                    "id": "wamid.HBgM",
+                    "type": "text",
+                    "statusCode": 200,
+                    "body": "duplicate",
+                }
+            ]
+        ),
+    }
+    assert process.call_count == send.call_count == 1
+    assert dedup_store.status("wamid.HBgM") == "done"
+
+    # a redelivery arriving while the message is processed is skipped too
+    dedup_store.conn.execute("DELETE FROM messages")
+    dedup_store.claim("wamid.HBgM")
+    assert json.loads(index.handler(message_text, None)["body"])[0]["body"] == (
+        "duplicate"
+    )
+    assert process.call_count == 1
+
+
+def test_queue_mode(message_text, dedup_store, tmp_path, mocker):
+    queue = SqliteQueue(tmp_path / "queue.sqlite")
+    mocker.patch("bot.utils.work_queue.from_env", return_value=queue)
+    mocker.patch.object(index, "WEBHOOK_MODE", "queue")
+    process = mocker.patch(
+        "bot.utils.parse.process_message",
+        return_value=[OutputMessage(price=100, lead_days=2, part_number="A0001")],
+    )
+    send = mocker.patch("bot.wa.send_retry", return_value=None)
+
+    resp = index.handler(message_text, None)
+    assert resp["statusCode"] == 200
+    assert json.loads(resp["body"])[0]["body"] == "OK"
+    process.assert_not_called()
+    assert len(queue) == 1
+
+    # a failed reply is retried later
+    assert json.loads(index.worker(None, None)["body"]) == {
+        "processed": 0,
+        "failed": 1,
+    }
+    assert len(queue) == 1
+
+    mocker.patch("time.time", return_value=1e10)
+    send.return_value = mocker.Mock(status_code=200, content=b"{}")
+    assert json.loads(index.worker(None, None)["body"]) == {
+        "processed": 1,
+        "failed": 0,
+    }
+    process.assert_called_with("hello world")
+    assert dedup_store.status("wamid.HBgM") == "done"
+    assert send.call_args.args[:2] == (
+        OutputMessage(price=100, lead_days=2, part_number="A0001").format(),
+        "9715",
+    )
+    assert len(queue) == 0
+
+
+def test_batched_delivery(message_batch, dedup_store, mocker):
+    body = json.loads(message_batch["body"])
+    assert [(msg.id, msg.text) for msg in wa.read_messages(body)] == [
+        ("wamid.1", "a"),
+        ("wamid.2", "b"),
+        ("wamid.3", "c"),
+    ]
+    assert wa.read_statuses(body) == [wa.MessageStatus(status="read", recipient="9715")]
+
+    mocker.patch(
+        "bot.utils.parse.process_message",
+        side_effect=lambda text: [OutputMessage(price=ord(text), lead_days=1)],
+    )
+    send = mocker.patch(
+        "bot.wa.send_retry",
+        side_effect=lambda text, *args, **kwargs: (
+            None if "98" in text else mocker.Mock(status_code=200, content=b"{}")
+        ),
+    )
+    resp = index.handler(message_batch, None)
+    assert send.call_count == 3
+    # the failed reply makes meta deliver the batch again
+    assert resp["statusCode"] == 500
+    assert [
+        (one["type"], one.get("id"), one["statusCode"])
+        for one in json.loads(resp["body"])
+    ] == [
+        ("text", "wamid.1", 200),
+        ("text", "wamid.2", 500),
+        ("text", "wamid.3", 200),
+        ("status", None, 200),
+    ]
+
+    send.side_effect = None
+    send.return_value = mocker.Mock(status_code=200, content=b"{}")
+    assert index.handler(message_batch, None)["statusCode"] == 200
+    assert send.call_count == 4
+
+
+def test_media_quote(message_media_image, message_media_video, dedup_store, mocker):
+    retrieve = mocker.patch("bot.wa.retrieve_media_url", return_value="https://media")
+    mocker.patch.object(
+        requests.Session,
+        "get",
+        side_effect=lambda *args, **kwargs: image_response(quote_image(1200, 800)),
+    )
+    # the child process would not see the patches below
+    mocker.patch(
+        "bot.utils.ocr.run_limited", side_effect=lambda func, *args: func(*args)
+    )
+    ocr_text = mocker.patch(
+        "pytesseract.image_to_string",
+        return_value="QUOTATION\nA1678853300 - 900 + vat 7-10 days\nTOTAL",
+    )
+    mocker.patch("bot.utils.parse.get_exchange_rate", return_value=20.0)
+    mocker.patch("bot.utils.parse.get_part_weight", return_value=1.0)
+    send = mocker.patch(
+        "bot.wa.send_retry", return_value=mocker.Mock(status_code=200, content=b"{}")
+    )
+
+    resp = index.handler(message_media_image, None)
+    assert json.loads(resp["body"])[0]["statusCode"] == 200
+    retrieve.assert_called_once_with("2295", index.HEADER_TOKEN)
+    text = send.call_args.args[0]
+    assert text.startswith("A1678853300\nЦена:")
+    assert "QUOTATION" not in text
+    ocr_text.assert_called_once()
+
+    # videos get an error reply
+    dedup_store.conn.execute("DELETE FROM messages")
+    ocr_text.reset_mock()
+    index.handler(message_media_video, None)
+    assert send.call_args.args[0].startswith("ERROR: only images")
+    ocr_text.assert_not_called()
+
+
+def test_progressive_reply(message_text, dedup_store, mocker):
+    mocker.patch.object(index, "REPLY_MODE", "progressive")
+    mocker.patch.object(index, "PROGRESSIVE_BATCH_SIZE", 3)
+    lines = [InputMessage(price=10 * (i + 1), lead_days=i) for i in range(7)]
+    mocker.patch("bot.utils.parse.parse_input_message", return_value=lines)
+    mocker.patch("bot.utils.parse.get_exchange_rate", return_value=20.0)
+    send = mocker.patch(
+        "bot.wa.send_retry", return_value=mocker.Mock(status_code=200, content=b"{}")
+    )
+
+    resp = index.handler(message_text, None)
+    assert resp["statusCode"] == 200
+    texts = [c.args[0] for c in send.call_args_list]
+    assert [text.count("Цена:") for text in texts] == [3, 3, 1, 0]
+    assert texts[-1].startswith("Итого: 7 поз.")
+
+    # a batch that was not delivered stops the reply
+    dedup_store.conn.execute("DELETE FROM messages")
+    send.reset_mock()
+    send.return_value = None
+    assert index.handler(message_text, None)["statusCode"] == 500
+    assert send.call_count == 1
+    assert dedup_store.status("wamid.HBgM") is None
+
+    # once a batch is delivered a redelivery does not send it again
+    dedup_store.conn.execute("DELETE FROM messages")
+    ok = mocker.Mock(status_code=200, content=b"{}")
+    send.reset_mock()
+    send.side_effect = [ok, None]
+    assert index.handler(message_text, None)["statusCode"] == 500
+    assert dedup_store.status("wamid.HBgM") == "done"
+    send.reset_mock()
+    assert json.loads(index.handler(message_text, None)["body"])[0]["body"] == (
+        "duplicate"
+    )
+    send.assert_not_called()
+
+
 def _load_json(file: Path) -> dict:
     with open(file) as f:
         return json.load(f)
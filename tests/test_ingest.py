@@ -0,0 +1,37 @@
+import shutil
+
+import pandas as pd
+
+from bot.workers import ingest
+from tests import synthetic
+
+
+def test_ingest_incremental(tmp_path):
+    orders = tmp_path / "orders"
+    orders.mkdir()
+    dataset = tmp_path / "dataset"
+    lines = synthetic.make_lines(30)
+    synthetic.render_humaid_ali(orders / "humaid.pdf", lines[:10])
+    synthetic.render_hnd(orders / "hnd.pdf", lines[10:])
+    # the same content under another name is ingested once
+    shutil.copy(orders / "hnd.pdf", orders / "hnd_copy.pdf")
+
+    summary = ingest.main([str(orders), str(dataset), "--n-jobs", "2"])
+    assert summary == ingest.IngestSummary(ingested=2, skipped=1, rows=30)
+    assert len([p for p in dataset.iterdir() if p.is_dir()]) == 2
+
+    summary = ingest.ingest(orders, dataset)
+    assert summary == ingest.IngestSummary(skipped=3)
+
+    synthetic.render_humaid_ali(
+        orders / "humaid_2.pdf", lines[:5], invoice_date="15/04/2023"
+    )
+    summary = ingest.ingest(orders, dataset)
+    assert summary == ingest.IngestSummary(ingested=1, skipped=3, rows=5)
+
+    res = pd.read_parquet(dataset)
+    assert len(res) == 35
+    assert res["file_hash"].nunique() == 3
+    assert set(res["supplier_name"]) == {"HND", "Humaid Ali Trading"}
+    assert set(res["part_number"]) == {one.part_number for one in lines}
+    assert len(ingest.read_manifest(dataset)) == 3
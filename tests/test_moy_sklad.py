@@ -0,0 +1,392 @@
+import itertools
+import json
+import time
+
+import pytest
+import requests
+
+from bot.scheme.enums import Currency
+from bot.scheme.parts import PartOrder
+from bot.services import moy_sklad
+from bot.services.moy_sklad import MoySkladSDK, RateLimiter, UpsertStats
+from bot.services.moy_sklad_cache import MetaCache, ProductMirror
+from tests import bench_moysklad, synthetic
+from tests.fake_moysklad import FakeMoySklad
+
+COUNTERPARTY = dict(href="https://api/entity/counterparty/1", type="counterparty")
+CURRENCY = dict(href="https://api/entity/currency/1", type="currency")
+
+
+class FakeProducts:
+    """In-memory product collection answering the JSON API requests."""
+
+    def __init__(self, rows: list[dict] = ()):
+        self.ids = itertools.count(1)
+        self.clock = itertools.count(1)
+        self.rows = {}
+        for row in rows:
+            self._save(dict(row))
+        self.calls = []
+        self.params = []
+
+    def _save(self, row: dict) -> dict:
+        if "meta" not in row:
+            row_id = str(next(self.ids))
+            row["id"] = row_id
+            row["meta"] = dict(href=f"https://api/entity/product/{row_id}")
+        row["updated"] = f"2023-05-01 00:00:{next(self.clock):02d}.000"
+        self.rows[row["meta"]["href"]] = {
+            **self.rows.get(row["meta"]["href"], {}),
+            **row,
+        }
+        return self.rows[row["meta"]["href"]]
+
+    def request(self, method, path, params=None, data=None):
+        self.calls.append((method, path))
+        self.params.append(params)
+        if path == "entity/supply":
+            hrefs = [p["assortment"]["meta"]["href"] for p in data["positions"]]
+            if not all(href in self.rows for href in hrefs):
+                resp = requests.Response()
+                resp.status_code = 412
+                raise requests.HTTPError(response=resp)
+            return dict(data, name="00001", moment=data["moment"])
+        assert path == "entity/product"
+        if method == "GET":
+            rows = list(self.rows.values())
+            filters = params.get("filter", "")
+            if filters.startswith("updated>="):
+                rows = [r for r in rows if r["updated"] >= filters[9:]]
+            elif filters:
+                articles = {f.split("=", 1)[1] for f in filters.split(";")}
+                rows = [r for r in rows if r.get("article") in articles]
+            offset = params.get("offset", 0)
+            return dict(
+                meta=dict(size=len(rows)),
+                rows=rows[offset : offset + params.get("limit", 1000)],
+            )
+        return [
+            self._save(dict(row))
+            if "meta" not in row or row["meta"]["href"] in self.rows
+            else dict(errors=[dict(code=1021, error="Объект не найден")])
+            for row in data
+        ]
+
+
+def _sdk(products: FakeProducts, mocker, **kwargs) -> MoySkladSDK:
+    kwargs = dict(
+        dict(
+            meta=dict(counterparty=COUNTERPARTY, currency=CURRENCY),
+            mirror=None,
+            meta_cache=None,
+        ),
+        **kwargs,
+    )
+    sdk = MoySkladSDK(**kwargs)
+    mocker.patch.object(MoySkladSDK, "_request", side_effect=products.request)
+    return sdk
+
+
+def _parts(n: int) -> list[PartOrder]:
+    return [
+        PartOrder(part_number=f"A{i:010d}", part_name="Brake pad", price=i + 1)
+        for i in range(n)
+    ]
+
+
+def test_upsert_products_batched(mocker):
+    parts = _parts(5)
+    products = FakeProducts(
+        [dict(article=parts[0].part_number, code=parts[0].part_number, name="Old")]
+    )
+    sdk = _sdk(products, mocker, batch_size=2)
+
+    metas, stats = sdk._upsert_products(parts + parts[:1])
+
+    assert (
+        products.calls == [("GET", "entity/product")] + [("POST", "entity/product")] * 3
+    )
+    assert len(products.rows) == 5
+    assert metas[0] == metas[-1] == dict(href="https://api/entity/product/1")
+    assert [products.rows[m["href"]]["article"] for m in metas[:-1]] == [
+        p.part_number for p in parts
+    ]
+    assert products.rows[metas[0]["href"]]["name"] == "Brake pad"
+    assert stats == UpsertStats(created=4, updated=1)
+
+    # nothing is sent when the catalog is up to date
+    products.calls.clear()
+    _, stats = sdk._upsert_products(parts)
+    assert products.calls == [("GET", "entity/product")]
+    assert stats == UpsertStats(unchanged=5)
+
+
+def test_upsert_products_duplicates(mocker):
+    parts = _parts(1)
+    row = dict(article=parts[0].part_number)
+    sdk = _sdk(FakeProducts([row, row]), mocker)
+    with pytest.raises(ValueError):
+        sdk._upsert_products(parts)
+
+
+def test_product_changes():
+    payload = dict(
+        name="Brake pad",
+        code="A0001",
+        article="A0001",
+        supplier=dict(meta=COUNTERPARTY),
+        buyPrice=dict(value=12.34 * 100, currency=dict(meta=CURRENCY)),
+    )
+    existing = dict(
+        id="1",
+        name="Brake pad ",
+        code="A0001",
+        article="A0001",
+        supplier=dict(meta=dict(COUNTERPARTY, metadataHref="https://api/meta")),
+        buyPrice=dict(
+            value=1234.0,
+            currency=dict(meta=dict(CURRENCY, href=CURRENCY["href"] + "?expand=")),
+        ),
+    )
+    assert moy_sklad.product_changes(payload, existing) == {}
+
+    existing["buyPrice"]["value"] = 1000.0
+    existing["name"] = "Old name"
+    assert moy_sklad.product_changes(payload, existing) == dict(
+        name=payload["name"], buyPrice=payload["buyPrice"]
+    )
+
+
+def test_product_mirror(mocker, tmp_path):
+    parts = _parts(3)
+    products = FakeProducts(
+        [dict(article=p.part_number, code=p.part_number, name="Old") for p in parts]
+    )
+    mirror = ProductMirror(tmp_path / "moysklad.sqlite")
+    sdk = _sdk(products, mocker, mirror=mirror)
+    mocker.patch("bot.services.moy_sklad.MAX_PAGE_SIZE", 2)
+
+    assert sdk.sync_products() == 3
+    assert len(mirror) == 3
+
+    # lookups are local, only writes go to the api
+    products.calls.clear()
+    metas, stats = sdk._upsert_products(parts)
+    assert products.calls == [("POST", "entity/product")]
+    assert stats == UpsertStats(updated=3)
+    assert mirror.find([parts[0].part_number])[parts[0].part_number][0]["meta"] == (
+        metas[0]
+    )
+    _, stats = sdk._upsert_products(parts)
+    assert stats == UpsertStats(unchanged=3)
+
+    # incremental sync only loads products changed since the last one and the
+    # latest one seen, which may share the timestamp with unseen changes
+    sdk.sync_products()
+    products._save(dict(products.rows[metas[0]["href"]], name="Changed"))
+    assert sdk.sync_products() == 2
+    assert mirror.find([parts[0].part_number])[parts[0].part_number][0]["name"] == (
+        "Changed"
+    )
+
+    del products.rows[metas[1]["href"]]
+    assert sdk.sync_products(full=True) == 2
+    assert len(mirror) == 2
+
+
+def test_product_mirror_stale(mocker, tmp_path):
+    parts = _parts(2)
+    products = FakeProducts(
+        [dict(article=p.part_number, code=p.part_number, name="Old") for p in parts]
+    )
+    mirror = ProductMirror(tmp_path / "moysklad.sqlite")
+    sdk = _sdk(products, mocker, mirror=mirror)
+    # lookups go to the api until the mirror is synced
+    sdk._upsert_products(parts)
+    assert products.calls[0] == ("GET", "entity/product")
+    sdk.sync_products()
+
+    # a product deleted upstream is still in the mirror after incremental syncs
+    deleted = products.rows.popitem()[1]
+    _, stats = sdk._upsert_products(parts)
+    assert stats == UpsertStats(unchanged=2)
+    sdk.meta.update(organization=COUNTERPARTY, store=COUNTERPARTY)
+    products.calls.clear()
+    supply = sdk.create_supply(parts)
+    assert products.calls == [
+        ("POST", "entity/supply"),
+        ("GET", "entity/product"),
+        ("POST", "entity/product"),
+        ("POST", "entity/supply"),
+    ]
+    hrefs = [p["assortment"]["meta"]["href"] for p in supply["positions"]]
+    assert deleted["meta"]["href"] not in hrefs
+    assert all(href in products.rows for href in hrefs)
+    assert len(mirror) == 2
+
+    # an update of a deleted product is rejected and the product is created
+    products.rows.popitem()
+    renamed = [p.copy(update=dict(part_name="New")) for p in parts]
+    metas, stats = sdk._upsert_products(renamed)
+    # the other product was updated by the rejected batch already
+    assert stats == UpsertStats(created=1, unchanged=1)
+    assert all(m["href"] in products.rows for m in metas)
+
+
+def test_meta_cache(mocker, tmp_path):
+    rows = [dict(name="AED", meta=CURRENCY), dict(name="USD", meta=COUNTERPARTY)]
+    list_entities = mocker.patch.object(
+        MoySkladSDK, "iter_entities", side_effect=lambda entity: iter(rows)
+    )
+    cache = MetaCache(tmp_path / "moysklad.sqlite")
+    names = dict(currency=Currency.aed)
+
+    sdk = _sdk(FakeProducts(), mocker, meta={}, meta_cache=cache, names=names)
+    assert sdk.currency == CURRENCY
+    # a new instance, like another script run, reads the persistent cache
+    sdk = _sdk(FakeProducts(), mocker, meta={}, meta_cache=cache, names=names)
+    assert sdk.currency == CURRENCY
+    assert list_entities.call_count == 1
+    assert cache.get("currency", "AED") == CURRENCY
+
+
+def test_meta_cache_accounts(mocker, tmp_path):
+    accounts = {
+        "org-1": dict(bankName="Bank", meta=CURRENCY),
+        "org-2": dict(bankName="Bank", meta=COUNTERPARTY),
+    }
+    mocker.patch.object(
+        MoySkladSDK,
+        "iter_entities",
+        side_effect=lambda entity: iter([accounts[sdk.organization["href"]]]),
+    )
+    cache = MetaCache(tmp_path / "moysklad.sqlite")
+    names = {"organization/accounts": "Bank"}
+
+    # an account of one organization is not reused for another
+    for org, expected in accounts.items():
+        sdk = _sdk(FakeProducts(), mocker, meta={}, meta_cache=cache, names=names)
+        sdk.meta["organization"] = dict(href=org)
+        assert getattr(sdk, "organization/accounts") == expected["meta"]
+    assert cache.get("organization/accounts", "org-1/Bank") == CURRENCY
+    assert cache.get("organization/accounts", "org-2/Bank") == COUNTERPARTY
+
+
+@pytest.mark.parametrize("prefetch", [0, 3])
+def test_iter_entities(mocker, prefetch):
+    products = FakeProducts([dict(article=f"A{i}") for i in range(25)])
+    sdk = _sdk(products, mocker)
+
+    rows = sdk.iter_entities("product", limit=4, prefetch=prefetch)
+    assert next(rows)["article"] == "A0"
+    assert len(products.calls) == 1
+    assert [row["article"] for row in rows] == [f"A{i}" for i in range(1, 25)]
+    assert len(products.calls) == 7
+
+    rows = list(sdk.iter_entities("product", filters=dict(article=["A3", "A7"])))
+    assert [row["article"] for row in rows] == ["A3", "A7"]
+    assert products.params[-1] == dict(
+        filter="article=A3;article=A7", limit=1000, offset=0
+    )
+
+    list(sdk.iter_entities("product", expand=["supplier", "images"]))
+    assert products.params[-1] == dict(expand="supplier,images", limit=100, offset=0)
+
+
+def test_rate_limiter(clock):
+    sleep = time.sleep
+    limiter = RateLimiter(rate=3, period=3.0, max_concurrent=2)
+    for _ in range(3):
+        with limiter:
+            pass
+    sleep.assert_not_called()
+    with limiter:
+        pass
+    assert sleep.call_args.args[0] == pytest.approx(1.0)
+
+    limiter.pause(5)
+    start = clock()
+    with limiter:
+        pass
+    # the bucket refills during the pause
+    assert clock() - start == pytest.approx(5)
+
+
+def _response(status: int, body=None, headers=None) -> requests.Response:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(body).encode()
+    resp.headers.update(headers or {})
+    return resp
+
+
+def test_request_retries_429(mocker, clock):
+    sdk = MoySkladSDK(mirror=None, meta_cache=None, limiter=RateLimiter())
+    sdk.init()
+    pause = mocker.spy(sdk.limiter, "pause")
+    request = mocker.patch.object(
+        sdk.session,
+        "request",
+        side_effect=[
+            _response(429, headers={"X-Lognex-Retry-After": "1500"}),
+            _response(429, headers={"Retry-After": "2"}),
+            _response(200, dict(rows=[])),
+        ],
+    )
+    assert sdk._request("GET", "entity/product") == dict(rows=[])
+    assert request.call_count == 3
+    assert [c.args[0] for c in pause.call_args_list] == [1.5, 2]
+
+    request.side_effect = [_response(500)]
+    with pytest.raises(requests.HTTPError):
+        sdk._request("GET", "entity/product")
+
+
+def test_import_orders_offline(tmp_path):
+    lines = synthetic.make_lines(30)
+    files = [
+        synthetic.render_humaid_ali(tmp_path / "humaid.pdf", lines[:10]),
+        synthetic.render_hnd(tmp_path / "hnd.pdf", lines[10:]),
+    ]
+    # the client allows more requests than the api to run into 429 responses
+    with FakeMoySklad(rate=6, period=0.5) as api:
+        sdk = bench_moysklad._sdk(api)
+        sdk.limiter = RateLimiter(rate=100, period=0.5)
+        orders = moy_sklad.read_orders([str(f) for f in files])
+        futures = moy_sklad.import_orders(sdk, orders)
+        supplies = [future.result()[0] for future in futures]
+
+        assert api.rejected > 0
+        assert [len(one["positions"]) for one in supplies] == [10, 20]
+        assert len(api.rows("paymentout")) == 2
+        assert {row["article"] for row in api.rows("product")} == {
+            one.part_number for one in lines
+        }
+        names = {row["meta"]["href"]: row["name"] for row in api.rows("counterparty")}
+        assert [names[one["agent"]["meta"]["href"]] for one in supplies] == [
+            "Humaid Ali Trading",
+            "HND",
+        ]
+
+
+def test_read_orders_skips_errors(tmp_path, mocker):
+    lines = synthetic.make_lines(5)
+    files = [
+        synthetic.render_humaid_ali(tmp_path / "humaid.pdf", lines),
+        tmp_path / "missing.pdf",
+        synthetic.render_hnd(tmp_path / "hnd.pdf", lines),
+    ]
+    error = mocker.patch.object(moy_sklad.logger, "error")
+    orders = moy_sklad.read_orders([str(f) for f in files])
+    assert [order.file for order, _ in orders] == [str(files[0]), str(files[2])]
+    assert error.call_count == 1
+    assert "missing.pdf" in error.call_args.args[0]
+
+
+def test_bench_moysklad(tmp_path):
+    results = bench_moysklad.run(
+        orders=2, lines=5, latency=0, workers=[1, 2], directory=tmp_path
+    )
+    assert len(results) == 2
+    assert (results["supplies"] == 2).all()
+    assert (results["rejected"] == 0).all()
@@ -0,0 +1,34 @@
+import time
+
+from bot.services.moy_sklad_cache import MetaCache, ProductMirror
+
+
+def test_meta_cache_ttl(tmp_path, mocker):
+    cache = MetaCache(tmp_path / "moysklad.sqlite", ttl=60)
+    meta = dict(href="https://api/entity/store/1")
+    cache.set("store", "Main", meta)
+    cache.set("currency", "AED", meta)
+    # another process sees the same database
+    assert MetaCache(cache.path).get("store", "Main") == meta
+    assert cache.get("store", "Other") is None
+
+    mocker.patch("time.time", return_value=time.time() + 61)
+    assert cache.get("store", "Main") is None
+    mocker.stopall()
+
+    assert cache.invalidate("store") == 1
+    assert cache.get("store", "Main") is None
+    assert cache.get("currency", "AED") == meta
+    assert cache.invalidate() == 1
+
+
+def test_from_env(tmp_path, monkeypatch):
+    monkeypatch.delenv("MOYSKLAD_CACHE_PATH", raising=False)
+    assert ProductMirror.from_env() is None
+    assert MetaCache.from_env() is None
+    monkeypatch.setenv("MOYSKLAD_CACHE_PATH", str(tmp_path / "moysklad.sqlite"))
+    monkeypatch.setenv("MOYSKLAD_META_TTL", "0")
+    assert ProductMirror.from_env().path == tmp_path / "moysklad.sqlite"
+    assert MetaCache.from_env() is None
+    monkeypatch.setenv("MOYSKLAD_CACHE_PATH", "")
+    assert ProductMirror.from_env() is None
@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+import pytest
+import requests
+
+from bot.utils import io, ocr
+from tests.conftest import image_response, quote_image
+
+# pylint: disable=no-member
+
+
+@pytest.mark.parametrize("ext", [".jpg", ".png"])
+def test_image_size(ext):
+    data = np.frombuffer(quote_image(640, 480, ext), dtype=np.uint8)
+    assert io.image_size(data) == (640, 480)
+    assert io.image_size(np.zeros(100, dtype=np.uint8)) is None
+
+
+@pytest.mark.parametrize("length", [True, False])
+def test_download_image(mocker, length):
+    content = quote_image(6000, 1000)
+    get = mocker.patch.object(
+        requests.Session, "get", return_value=image_response(content, length)
+    )
+    data = io.download_bytes("https://media", headers={"Authorization": "x"})
+    assert data.tobytes() == content
+    assert get.call_args.kwargs["stream"]
+
+    get.return_value = image_response(content, length)
+    imdecode = mocker.spy(cv2, "imdecode")
+    img = io.download_image("https://media", max_side=2400, gray=True)
+    assert imdecode.call_args.args[1] == cv2.IMREAD_REDUCED_GRAYSCALE_2
+    # decoded at half the size right away, then downscaled
+    assert img.shape == (400, 2400)
+
+    get.return_value = image_response(content, length)
+    with pytest.raises(ValueError):
+        io.download_bytes("https://media", max_bytes=len(content) - 1)
+
+
+def test_decode_image_downscaled():
+    data = np.frombuffer(quote_image(1000, 500, ".png"), dtype=np.uint8)
+    assert io.decode_image(data, max_side=400).shape == (200, 400, 3)
+    assert io.decode_image(data).shape == (500, 1000, 3)
+
+
+def allocate(mb: int) -> int:
+    return int(np.ones(mb * 1024 * 1024, dtype=np.uint8).sum())
+
+
+def test_run_limited():
+    assert ocr.run_limited(allocate, 10, memory_mb=100) == 10 * 1024 * 1024
+    with pytest.raises(MemoryError):
+        ocr.run_limited(allocate, 200, memory_mb=100)
@@ -1,9 +1,16 @@
+import gc
+import tracemalloc
 from pathlib import Path
 
+import pandas as pd
+import pdfplumber
 import pydantic
 import pytest
 
+from bot.scheme.parts import PartOrder
+from bot.utils.layout import LayoutCache, WordIndex
 from bot.workers import pdf
+from tests import bench_scaling, synthetic
 
 THIS_DIR = Path(__file__).parent
 
@@ -156,3 +163,271 @@ def _check_items(res, check_items):
             actual = res.iloc[expected.index - 1].to_dict()
             actual = CheckItem(index=expected.index, **actual)
             assert actual == expected
+
+
+@pytest.mark.parametrize("processor,render", synthetic.LAYOUTS.items())
+def test_parallel_pages(tmp_path, processor, render):
+    lines = synthetic.make_lines(60)
+    file = render(tmp_path / "invoice.pdf", lines, rows_per_page=20)
+    proc = processor(file=str(file), checksum=synthetic.checksum(lines))
+    pd.testing.assert_frame_equal(proc.run(n_jobs=1), proc.run(n_jobs=2))
+
+
+def _word(text, x0, top):
+    return dict(text=text, x0=x0, x1=x0 + 5 * len(text), top=top, bottom=top + 8)
+
+
+def test_word_index():
+    words = WordIndex(
+        words=[
+            _word("Sr.", 10, 100),
+            _word("No.", 30, 100),
+            _word("Tax", 300, 100),
+            _word("5%", 320, 100),
+            _word("Sr.", 10, 200),
+            _word("No.", 30, 240),
+            _word("Tax", 300, 240),
+        ]
+    )
+    match, *rest = words.search("Sr. No.")
+    assert not rest
+    assert (match["x0"], match["x1"], match["top"]) == (10, 45, 100)
+    assert words.search("Tax 5%")[0]["x1"] == 330
+    assert [m["top"] for m in words.search("Tax")] == [100, 240]
+    assert [m["top"] for m in words.search("Tax", bbox=(0, 150, 600, 300))] == [240]
+    assert words.search("Total") == []
+
+
+def test_iter_pages_memory(tmp_path):
+    """Memory stays flat while streaming a long invoice."""
+    lines = synthetic.make_lines(1000)
+    file = synthetic.render_humaid_ali(tmp_path / "invoice.pdf", lines, rows_per_page=2)
+    proc = pdf.PdfOrderHumaidAli(file=str(file))
+
+    tracemalloc.start()
+    try:
+        n_pages, n_rows, after_50 = 0, 0, None
+        for table in proc.iter_pages():
+            n_pages += 1
+            n_rows += len(table)
+            if n_pages == 50:
+                # cycles left by pdfplumber pages are freed at gc's discretion
+                gc.collect()
+                after_50, _ = tracemalloc.get_traced_memory()
+        gc.collect()
+        after_500, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert n_pages == 500
+    assert n_rows == len(lines)
+    assert after_500 - after_50 < 256 * 1024
+
+
+@pytest.mark.parametrize("processor,render", synthetic.LAYOUTS.items())
+def test_run_streams_pages(tmp_path, mocker, processor, render):
+    lines = synthetic.make_lines(60)
+    file = render(tmp_path / "invoice.pdf", lines, rows_per_page=20)
+    # pdf.pages would create every page of the document at once
+    mocker.patch.object(
+        pdfplumber.PDF,
+        "pages",
+        new_callable=mocker.PropertyMock,
+        side_effect=AssertionError("all pages are loaded"),
+    )
+    count = mocker.spy(pdf, "_count_pages")
+    proc = processor(file=str(file), checksum=synthetic.checksum(lines))
+    assert len(proc.run()) == len(proc.run(n_jobs=2)) == len(lines)
+    assert count.spy_return == 3
+
+
+@pytest.mark.parametrize("processor,render", synthetic.LAYOUTS.items())
+def test_detect_supplier(tmp_path, processor, render):
+    lines = synthetic.make_lines(30)
+    file = render(tmp_path / "invoice.pdf", lines)
+
+    best, *rest = pdf.detect_supplier(str(file))
+    assert best.processor is processor
+    assert best.confidence == 1.0
+    assert all(one.confidence < best.confidence for one in rest)
+
+    match, res = pdf.process_order(str(file), checksum=synthetic.checksum(lines))
+    assert match.processor is processor
+    assert list(res["part_number"]) == [one.part_number for one in lines]
+
+
+def test_process_order_fallback(tmp_path, mocker):
+    lines = synthetic.make_lines(5)
+    file = synthetic.render_humaid_ali(tmp_path / "invoice.pdf", lines)
+    mocker.patch(
+        "bot.workers.pdf.detect_supplier",
+        return_value=[
+            pdf.SupplierMatch(pdf.PdfOrderHND, 0.5),
+            pdf.SupplierMatch(pdf.PdfOrderHumaidAli, 0.0),
+        ],
+    )
+    warning = mocker.patch.object(pdf.logger, "warning")
+    match, res = pdf.process_order(str(file))
+    assert match.processor is pdf.PdfOrderHumaidAli
+    assert len(res) == len(lines)
+    assert isinstance(warning.call_args.kwargs["exc_info"], ValueError)
+
+    # other errors are bugs and are not hidden by the fallback
+    mocker.patch.object(pdf.PdfOrderHND, "run", side_effect=TypeError("bug"))
+    with pytest.raises(TypeError):
+        pdf.process_order(str(file))
+
+
+def test_process_order_wrong_columns(tmp_path, mocker):
+    lines = synthetic.make_lines(5)
+    file = synthetic.render_humaid_ali(tmp_path / "invoice.pdf", lines)
+    mocker.patch(
+        "bot.workers.pdf.detect_supplier",
+        return_value=[
+            pdf.SupplierMatch(pdf.PdfOrderEuropeanAutospares, 0.5),
+            pdf.SupplierMatch(pdf.PdfOrderHumaidAli, 0.0),
+        ],
+    )
+    # the date of the wrong supplier parses, its table has too few columns
+    mocker.patch.object(
+        pdf.PdfOrderEuropeanAutospares,
+        "extract_invoice_date",
+        return_value="2023-04-26",
+    )
+    warning = mocker.patch.object(pdf.logger, "warning")
+    match, res = pdf.process_order(str(file))
+    assert match.processor is pdf.PdfOrderHumaidAli
+    assert len(res) == len(lines)
+    assert "columns" in str(warning.call_args.kwargs["exc_info"])
+
+
+def test_layout_cache(tmp_path, mocker):
+    lines = synthetic.make_lines(60)
+    file = synthetic.render_hnd(tmp_path / "invoice.pdf", lines)
+    expected = pdf.PdfOrderHND(file=str(file), layout_cache=None).run()
+    spy = mocker.spy(WordIndex, "from_page")
+
+    # the first page is searched, the others reuse its geometry
+    cache = LayoutCache(tmp_path / "layouts")
+    res = pdf.PdfOrderHND(file=str(file), layout_cache=cache).run()
+    pd.testing.assert_frame_equal(res, expected)
+    assert spy.call_count == 2  # the first page and the invoice date
+    assert len(cache.get("HND-1")) == 1
+
+    # geometry is loaded from disk by a new cache
+    spy.reset_mock()
+    cache = LayoutCache(tmp_path / "layouts")
+    res = pdf.PdfOrderHND(file=str(file), layout_cache=cache).run()
+    pd.testing.assert_frame_equal(res, expected)
+    assert spy.call_count == 1
+
+    # labels at other positions do not match the signature
+    geometry = cache.get("HND-1")[0].copy(deep=True)
+    geometry.labels[1].x0 += 50
+    geometry.labels[1].x1 += 50
+    cache = LayoutCache(tmp_path / "other")
+    cache.add("HND-1", geometry)
+    spy.reset_mock()
+    res = pdf.PdfOrderHND(file=str(file), layout_cache=cache).run()
+    pd.testing.assert_frame_equal(res, expected)
+    assert spy.call_count == 2
+    assert len(cache.get("HND-1")) == 2
+
+
+def test_layout_cache_from_env(tmp_path, monkeypatch):
+    monkeypatch.delenv("PDF_LAYOUT_CACHE_DIR", raising=False)
+    assert pdf.PdfOrderHND(file="").layout_cache is None
+
+    monkeypatch.setenv("PDF_LAYOUT_CACHE_DIR", str(tmp_path / "layouts"))
+    cache = pdf.PdfOrderHND(file="").layout_cache
+    assert cache.directory == tmp_path / "layouts"
+
+
+@pytest.mark.parametrize("processor,render", synthetic.LAYOUTS.items())
+def test_words_engine(tmp_path, processor, render):
+    lines = synthetic.make_lines(100)
+    file = render(tmp_path / "invoice.pdf", lines)
+    results = [
+        processor(
+            file=str(file), checksum=synthetic.checksum(lines), engine=engine
+        ).run()
+        for engine in ["table", "words"]
+    ]
+    pd.testing.assert_frame_equal(*results)
+
+
+def test_parse_table_frame():
+    proc = pdf.PdfOrderEuropeanAutospares(file="", layout_cache=None)
+    header = ["No.", "Part", "Description", "Unit", "Qty", "Price", "Disc", "Amount"]
+    rows = [
+        header,
+        ["1", "M A447 680 25 069051", "COVER", "PCS", "1.00", "422.00", "0", "422"],
+        ["", "", "LEFT SIDE", "", "", "", "", ""],
+        ["", "", "", "", "", "", "", ""],
+        ["2", "M A000-9897.006", "OIL", "PCS", "4.00", "1,127.50", "5", "4,510"],
+        [None, None, None, None, None, "Subtotal", None, None],
+    ]
+    expected = [
+        PartOrder(
+            part_number="A44768025069051",
+            part_name="Cover left side",
+            quantity=1,
+            price=422,
+            discount=0,
+        ),
+        PartOrder(
+            part_number="A0009897006",
+            part_name="Oil",
+            quantity=4,
+            price=1127.5,
+            discount=5,
+        ),
+    ]
+    frame = proc.parse_table_frame([list(row) for row in rows])
+    pd.testing.assert_frame_equal(frame, proc.as_table(expected))
+    assert proc.to_parts(frame) == expected
+
+    rows[4][5] = "n/a"
+    with pytest.raises(ValueError, match="Invalid price"):
+        proc.parse_table_frame([list(row) for row in rows])
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        [["PART NO", "DESCRIPTION", "QTY", "UNIT PRICE"], ["", "", "", ""]],
+        [["PART NO", "DESCRIPTION", "QTY", "UNIT PRICE"]],
+        [["PART", "", "", "UNIT"], ["NO", "DESCRIPTION", "QTY", "PRICE"]],
+    ],
+)
+def test_humaid_ali_filter_rows(header):
+    proc = pdf.PdfOrderHumaidAli(file="", layout_cache=None)
+    rows = [
+        ["A8742547345", "OIL FILTER", "17", "740.19"],
+        ["", "", "", ""],
+        ["A2762998937", "BUMPER BRACKET", "n/a", "2,945.03"],
+    ]
+    assert proc.filter_rows(header + rows) == [rows[0], rows[2]]
+
+
+@pytest.mark.parametrize(
+    "processor,name,checksum",
+    bench_scaling.ORDERS,
+    ids=[name for _, name, _ in bench_scaling.ORDERS],
+)
+def test_bench_orders(processor, name, checksum):
+    if not (bench_scaling.ORDERS_DIR / name).exists():
+        pytest.skip(f"{name} is not in {bench_scaling.ORDERS_DIR}")
+    results = bench_scaling.run_orders([(processor, name, checksum)], jobs=[1, 2])
+    print(results.to_string(index=False))
+    assert list(results["n_jobs"]) == [1, 2]
+    assert results["rows"].nunique() == 1
+    assert (results["seconds"] > 0).all()
+
+
+def test_bench_scaling(tmp_path):
+    results = bench_scaling.run(pages=[1, 2], engines=["table"], directory=tmp_path)
+    assert len(results) == 2 * len(synthetic.LAYOUTS)
+    assert (results["rows"] == results["pages"] * bench_scaling.ROWS_PER_PAGE).all()
+    assert (results["pages_per_second"] > 0).all()
+    assert results["exponent"].notna().sum() == len(synthetic.LAYOUTS)
@@ -1,6 +1,8 @@
+import threading
+
 import pytest
 
-from bot.scheme.messages import InputMessage
+from bot.scheme.messages import InputMessage, OutputMessage
 from bot.services.utils import get_exchange_rate
 from bot.utils import parse
 from bot.workers import text
@@ -284,3 +286,36 @@ def test_process_message(mocker, message, expected):
     assert len(output) == len(expected)
     for out, exp in zip(output, expected):
         assert out.dict() == exp
+
+
+def test_prepare_outputs(mocker):
+    rate = mocker.patch("bot.utils.parse.get_exchange_rate", return_value=20.0)
+    slowest = threading.Event()
+
+    def weight(part_number):
+        if part_number == "A0000000004":
+            assert slowest.wait(5)
+        return 1.0
+
+    mocker.patch("bot.utils.parse.get_part_weight", side_effect=weight)
+    messages = [
+        InputMessage(price=100 + i, lead_days=i, part_number=f"A{i:010d}")
+        for i in range(5)
+    ]
+    batches = parse.prepare_outputs(messages, batch_size=2)
+    # the first lines are sent while the last one is still priced
+    assert [out.part_number for out in next(batches)] == ["A0000000000", "A0000000001"]
+    assert [out.part_number for out in next(batches)] == ["A0000000002", "A0000000003"]
+    slowest.set()
+    assert [out.part_number for out in next(batches)] == ["A0000000004"]
+    assert next(batches, None) is None
+    # the rate is requested before the lines are priced
+    assert rate.call_args_list[0].args[0] == "AED"
+
+
+def test_format_summary():
+    outputs = [
+        OutputMessage(price=1000.4, lead_days=15),
+        OutputMessage(price=2000.4, lead_days=30),
+    ]
+    assert parse.format_summary(outputs) == ("Итого: 2 поз.\nСрок поставки: до 30 дн.")
@@ -5,6 +5,8 @@ import pytest
 from bot.scheme.enums import ShippingType
 from bot.scheme.parts import PartQuoteExtended
 from bot.services import ford, mercedes
+from bot.services import utils as services
+from bot.services.weight_cache import WeightCache
 from bot.utils.table import PandasMixin
 
 TEST_DATA_DIR = Path(__file__).parent / "data" / "parts"
@@ -83,3 +85,49 @@ def test_total_cost_calculation():
 def _read_html_page(part_number: str) -> str:
     file = TEST_DATA_DIR / f"{part_number}.html"
     return file.read_text()
+
+
+def test_weight_cache_from_env(tmp_path, monkeypatch):
+    monkeypatch.delenv("WEIGHT_CACHE_PATH", raising=False)
+    assert WeightCache.from_env() is None
+    monkeypatch.setenv("WEIGHT_CACHE_PATH", str(tmp_path / "weights.sqlite"))
+    monkeypatch.setenv("WEIGHT_CACHE_TTL", "100")
+    cache = WeightCache.from_env()
+    assert (cache.path, cache.ttl) == (tmp_path / "weights.sqlite", 100)
+
+
+def test_part_weight_cache(mocker, tmp_path):
+    cache = WeightCache(tmp_path / "weights.sqlite", ttl=100)
+    mocker.patch("bot.services.weight_cache.from_env", return_value=cache)
+    scrape = mocker.patch(
+        "bot.services.mercedes.get_mercedes_weight", side_effect=[0.9, 1.0, 1.1]
+    )
+    assert services.get_part_weight("A1679063107") == 0.9
+    assert services.get_part_weight("A1679063107") == 0.9
+    assert scrape.call_count == 1
+
+    # weights of recently quoted parts are scraped again once they expire
+    cache.quoted("A0259975047")
+    assert cache.stale() == ["A0259975047"]
+    assert services.prime_weights() == 1
+    assert cache.get("A0259975047") == 1.0
+    now = mocker.patch("time.time", return_value=1e10)
+    assert cache.stale() == []
+    cache.quoted("A1679063107")
+    assert cache.stale() == ["A1679063107"]
+    assert services.prime_weights() == 1
+    assert cache.get("A1679063107") == 1.1
+    now.return_value += 8 * 24 * 60 * 60
+    assert cache.stale() == []
+
+
+def test_exchange_rate_cached(mocker):
+    services._get_exchange_rate.cache_clear()
+    request = mocker.patch(
+        "bot.services.utils.make_request",
+        return_value={"rates": {"2021-01-01": {"RUB": 20.0}}},
+    )
+    for _ in range(2):
+        assert services.get_exchange_rate("AED", "RUB", "2021-01-01") == 20.0
+    assert request.call_count == 1
+    services._get_exchange_rate.cache_clear()
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.utils import store
+from bot.utils.store import SqliteStore
+
+
+class Notes(SqliteStore):
+    schema = "CREATE TABLE IF NOT EXISTS notes (text TEXT);"
+    repr_fields = ("path", "ttl")
+
+    def __init__(self, path, ttl=10):
+        super().__init__(path)
+        self.ttl = ttl
+
+
+def test_sqlite_store(tmp_path):
+    notes = Notes(tmp_path / "sub" / "notes.sqlite")
+    assert (
+        repr(notes) == f"Notes(path={str(tmp_path / 'sub' / 'notes.sqlite')!r}, ttl=10)"
+    )
+    # the file is created on first use
+    assert not notes.path.exists()
+    with ThreadPoolExecutor(4) as pool:
+        conns = set(pool.map(lambda _: id(notes.conn), range(8)))
+    assert len(conns) == 1
+    assert notes.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    with notes.conn:
+        notes.conn.execute("INSERT INTO notes VALUES ('a')")
+    assert (
+        Notes(notes.path).conn.execute("SELECT text FROM notes").fetchone()["text"]
+        == "a"
+    )
+
+
+def test_open_once(tmp_path, monkeypatch):
+    def factory():
+        return Notes(tmp_path / f"{len(opened)}.sqlite")
+
+    opened = []
+    monkeypatch.setattr(store, "_opened", {})
+    monkeypatch.setenv("NOTES_TTL", "1")
+    opened.append(store.open_once(factory, "NOTES_TTL"))
+    assert store.open_once(factory, "NOTES_TTL") is opened[0]
+    # other settings open another store
+    monkeypatch.setenv("NOTES_TTL", "2")
+    assert store.open_once(factory, "NOTES_TTL") is not opened[0]
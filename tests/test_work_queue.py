@@ -0,0 +1,41 @@
+import pytest
+
+from bot.utils import work_queue
+from bot.utils.work_queue import SqliteQueue
+
+
+def test_sqlite_queue(tmp_path, mocker):
+    queue = SqliteQueue(tmp_path / "queue.sqlite")
+    assert queue.get() is None
+    first = queue.put({"n": 1})
+    queue.put({"n": 2})
+    assert len(queue) == 2
+
+    job = queue.get(visibility_timeout=60)
+    assert (job.id, job.payload, job.attempts) == (first, {"n": 1}, 1)
+    # taken jobs are hidden from other workers until acknowledged
+    assert queue.get().payload == {"n": 2}
+    assert queue.get() is None
+
+    queue.ack(job)
+    assert len(queue) == 1
+
+    # a job not acknowledged in time is handed out again
+    now = mocker.patch("time.time", return_value=1e10)
+    job = queue.get()
+    assert (job.payload, job.attempts) == ({"n": 2}, 2)
+    queue.nack(job, delay=10)
+    assert queue.get() is None
+    now.return_value += 10
+    assert queue.get().attempts == 3
+
+
+def test_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv("WORK_QUEUE_URL", f"sqlite://{tmp_path}/queue.sqlite")
+    queue = work_queue.from_env()
+    assert isinstance(queue, SqliteQueue)
+    assert queue.path == tmp_path / "queue.sqlite"
+    assert work_queue.from_env() is queue
+
+    with pytest.raises(ValueError):
+        work_queue.from_url("redis://localhost")